@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# (C) Nikhef 2019 Mischa Salle
+
+# Benchmark of mkprivkey() in privkey_write.py for 2048 to 16384 bit
+# moduli, with each of the available arithmetic backends, against the
+# original four egcd inversions.  The "primes" are random odd numbers
+# for which the inversions exist, which is all the arithmetic needs.
+#
+# Usage: bench/bench_arith.py
+
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import privkey_write
+from privkey_write import egcd, inv_egcd, invbackends
+
+
+def mkprivkey_orig(mod, exp, p):
+    """ The original mkprivkey: four egcd inversions """
+    q = mod // p
+    return [0, mod, exp, inv_egcd(exp, (p-1)*(q-1)), p, q,
+            inv_egcd(exp, p-1), inv_egcd(exp, q-1), inv_egcd(q, p)]
+
+
+def fakekey(bits, exp):
+    """ Return mod and p for which all inversions in mkprivkey exist """
+    rnd = random.Random(bits)
+    while(True):
+        p = rnd.getrandbits(bits // 2) | (1 << (bits//2 - 1)) | 1
+        q = rnd.getrandbits(bits // 2) | (1 << (bits//2 - 1)) | 1
+        if(egcd(exp, (p-1)*(q-1))[2] == 1 and egcd(q, p)[2] == 1):
+            return (p*q, p)
+
+
+def bench(func, mod, exp, p, repeat):
+    """ Time func, returning the best time in seconds """
+    return min(timeit.repeat(lambda: func(mod, exp, p), number=1, repeat=repeat))
+
+
+def main():
+    exp = 65537
+    names = ["orig"] + [name for (name, f) in invbackends]
+    print("{:>6}".format("bits") + "".join("{:>12}".format(n+" (ms)") for n in names))
+    for bits in (2048, 4096, 8192, 16384):
+        mod, p = fakekey(bits, exp)
+        times = [bench(mkprivkey_orig, mod, exp, p, 5)]
+        for (name, f) in invbackends:
+            privkey_write.inv = f
+            assert privkey_write.mkprivkey(mod, exp, p) == mkprivkey_orig(mod, exp, p)
+            times.append(bench(privkey_write.mkprivkey, mod, exp, p, 5))
+        print("{:>6}".format(bits) + "".join("{:>12.3f}".format(1000*t) for t in times))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# (C) Nikhef 2019 Mischa Salle
+
+# Benchmark of the audit log in privkey_audit.py: for a log of n entries
+# in a temporary directory, the time of an append, a tree head, and an
+# inclusion and consistency proof with their verification, against
+# recomputing the tree head from all entries (as blocktree/timber.c does).
+# Appends fsync the files, so their time depends mostly on the disk.
+#
+# Usage: bench/bench_audit.py [<entries>]
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from privkey_audit import AuditLog, leafhash, nodehash, splitsize, verifyinclusion, verifyconsistency
+
+
+def treehash(leaves):
+    """ Recompute the tree head from all leaf hashes """
+    if(len(leaves) == 1):
+        return leaves[0]
+    k = splitsize(len(leaves))
+    return nodehash(treehash(leaves[:k]), treehash(leaves[k:]))
+
+
+def timed(func, repeat=20):
+    """ Return the best time in ms of func, and its result """
+    best = None
+    for i in range(repeat):
+        t = time.time()
+        result = func()
+        t = time.time()-t
+        best = t if best is None else min(best, t)
+    return (1000*best, result)
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    tmp = tempfile.mkdtemp()
+    try:
+        log = AuditLog(os.path.join(tmp, 'log'))
+        t = time.time()
+        for i in range(n):
+            log.append(('{"op":"split","n":%d}' % i).encode('ASCII'))
+        print("{} entries".format(n))
+        print("{:>32} {:>8.3f} ms".format("append (mean)", 1000*(time.time()-t)/n))
+        (t, (size, root)) = timed(log.head)
+        print("{:>32} {:>8.3f} ms".format("tree head", t))
+
+        def recompute():
+            with open(log.filename, mode="rb") as f:
+                return treehash([leafhash(line.rstrip(b'\n')) for line in f])
+        (t, full) = timed(recompute, 3)
+        assert full == root
+        print("{:>32} {:>8.3f} ms".format("tree head, recomputed", t))
+        i = n // 3
+        (t, (leaf, proof)) = timed(lambda: log.inclusion(i))
+        print("{:>32} {:>8.3f} ms".format("inclusion proof", t))
+        (t, ok) = timed(lambda: verifyinclusion(leaf, i, n, proof, root))
+        assert ok
+        print("{:>32} {:>8.3f} ms".format("inclusion verify", t))
+        (m, old) = log.head(i)
+        (t, proof) = timed(lambda: log.consistency(m))
+        print("{:>32} {:>8.3f} ms".format("consistency proof", t))
+        (t, ok) = timed(lambda: verifyconsistency(m, n, old, root, proof))
+        assert ok
+        print("{:>32} {:>8.3f} ms".format("consistency verify", t))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == "__main__":
+    main()
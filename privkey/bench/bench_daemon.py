@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# (C) Nikhef 2019 Mischa Salle
+
+# Benchmark of the per-request latency of privkeyd.py, on one connection
+# and with a new connection per request, against the start-up of a new
+# interpreter importing convert.py, which every call of the scripts pays.
+# The daemon serves two temporary random files of 1 MiB, and a hex encoded
+# one, with which it is first checked that concurrent splits and joins,
+# answered in separate threads, give back the key.
+#
+# Usage: bench/bench_daemon.py [<requests>]
+
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+here = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, here)
+
+import privkey_write
+from privkey_read import pemtoasn
+from privkey_write import packframe
+from privkeyd import splitrequest, joinrequest, request
+
+
+def check(path, key, names, threads=8, n=40):
+    """ Split and join the key from threads clients at once, returning the number of keys not given back """
+    der = bytes(pemtoasn(key))
+    failed = [0]
+
+    def client(t):
+        frames = []
+        for i in range(n):
+            offsets = [256*(t*n+i) for name in names]
+            fields = request(path, splitrequest(key, names, offsets))
+            frames.append(packframe(list(fields.items()), privkey_write.framemasked))
+        for frame in frames:
+            try:
+                if(bytes(request(path, joinrequest(frame, names))[privkey_write.framekey]) != der):
+                    failed[0] += 1
+            except ValueError:
+                failed[0] += 1
+
+    clients = [threading.Thread(target=client, args=(t,)) for t in range(threads)]
+    for c in clients:
+        c.start()
+    for c in clients:
+        c.join()
+    return failed[0]
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    with open(os.path.join(here, 'example_data', 'privkeyrsa_plain.pem'), mode="rb") as f:
+        key = f.read()
+    tmp = tempfile.mkdtemp()
+    path = os.path.join(tmp, 'sock')
+    names = [os.path.join(tmp, 'pad1'), os.path.join(tmp, 'pad2')]
+    for name in names:
+        with open(name, mode="wb") as f:
+            f.write(os.urandom(1 << 20))
+    hexname = os.path.join(tmp, 'pad3')
+    with open(hexname, mode="w") as f:
+        f.write(os.urandom(1 << 20).hex())
+    daemon = subprocess.Popen([sys.executable, os.path.join(here, 'privkeyd.py'), path]+names+[hexname])
+    try:
+        while(not os.path.exists(path)):
+            time.sleep(0.01)
+        failed = check(path, key, [names[0], hexname])
+        if(failed):
+            sys.stderr.write("ERROR: {} concurrently split keys not given back\n".format(failed))
+            return 1
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(path)
+            t0 = time.time()
+            frames = []
+            for i in range(n):
+                fields = request(path, splitrequest(key, names, [256*i, 256*(n+i)]), sock)
+                frames.append(packframe(list(fields.items()), privkey_write.framemasked))
+            t1 = time.time()
+            for frame in frames:
+                request(path, joinrequest(frame, names), sock)
+            t2 = time.time()
+        for i in range(n):
+            request(path, splitrequest(key, names, [256*i, 256*(n+i)]))
+        t3 = time.time()
+        for i in range(5):
+            subprocess.check_call([sys.executable, '-c', 'import convert'], cwd=here)
+        t4 = time.time()
+    finally:
+        daemon.terminate()
+        daemon.wait()
+        shutil.rmtree(tmp)
+    print("{:>32} {:>8.3f} ms".format("split, one connection", 1000*(t1-t0)/n))
+    print("{:>32} {:>8.3f} ms".format("join, one connection", 1000*(t2-t1)/n))
+    print("{:>32} {:>8.3f} ms".format("split, connection per request", 1000*(t3-t2)/n))
+    print("{:>32} {:>8.3f} ms".format("interpreter start-up", 1000*(t4-t3)/5))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# (C) Nikhef 2019 Mischa Salle
+
+# Benchmark of encrypting reconstructed keys with openssl rsa -des3, as
+# convert_revert.py --batch does: one openssl process after another, as
+# before, against the pool of privkey_opensslpool.py with 1, 2, 4, ... up to
+# the number of CPUs processes at a time.  Both hand openssl the pass
+# phrase with -passout fd:<n>.
+#
+# Requires Python 3.5 or later.
+#
+# Usage: bench/bench_openssl.py [<keys>] [<bits>]
+
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from privkey_openssl import passphrasepipe
+from privkey_opensslpool import runpipeline
+
+cmd = ['openssl', 'rsa', '-des3']
+passphrase = bytearray(b'benchmark')
+
+
+def serial(keys):
+    """ Encrypt the keys one openssl process at a time """
+    for key in keys:
+        fd = passphrasepipe(passphrase)
+        try:
+            pipe = subprocess.Popen(cmd+['-passout', 'fd:%d' % fd], stdin=subprocess.PIPE,
+                                    stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, pass_fds=(fd,))
+            (out, err) = pipe.communicate(key)
+        finally:
+            os.close(fd)
+        assert pipe.returncode == 0
+
+
+def pool(keys, limit):
+    """ Encrypt the keys with at most limit openssl processes at a time """
+    def emit(tag, out, error):
+        assert error is None
+    runpipeline(((i, bytearray(key), None) for (i, key) in enumerate(keys)),
+                cmd, emit, passphrase, '-passout', limit)
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    bits = sys.argv[2] if len(sys.argv) > 2 else '2048'
+    key = subprocess.check_output(['openssl', 'genrsa', '-traditional', bits], stderr=subprocess.DEVNULL)
+    keys = [key]*n
+    print("{} keys of {} bits, {} CPUs".format(n, bits, os.cpu_count()))
+    t = time.time()
+    serial(keys)
+    base = time.time()-t
+    print("{:>12} {:>10.3f} s".format("serial", base))
+    limit = 1
+    while True:
+        # openssl writes 'writing RSA key' on stderr for every key
+        with open(os.devnull, 'w') as null:
+            stderr = os.dup(2)
+            os.dup2(null.fileno(), 2)
+            try:
+                t = time.time()
+                pool(keys, limit)
+                t = time.time()-t
+            finally:
+                os.dup2(stderr, 2)
+                os.close(stderr)
+        print("{:>12} {:>10.3f} s {:>6.2f}x".format("pool of {}".format(limit), t, base/t))
+        if limit >= (os.cpu_count() or 1):
+            break
+        limit = min(2*limit, os.cpu_count())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# (C) Nikhef 2019 Mischa Salle
+
+# Benchmark of readtlvasn1() in privkey_read.py on 4096, 8192 and 16384
+# bit keys, comparing the byte at a time integer decoding with
+# int.from_bytes.  The keys are synthesised with random integers of the
+# right sizes, as the parser does not care whether they are consistent.
+#
+# Usage: bench/bench_parse.py
+
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import privkey_read
+from privkey_write import writeseqtlvasn1
+
+
+def octets2int_loop(octets, offs, size):
+    """ The original byte at a time integer decoding """
+    v = 0
+    while(offs < size):
+        v <<= 8
+        v |= octets[offs]
+        offs += 1
+    return v
+
+
+def fakekey(bits):
+    """ DER encode an RSAPrivateKey of bits bits with random values """
+    rnd = random.Random(bits)
+    half = bits // 2
+    return writeseqtlvasn1([0, rnd.getrandbits(bits), 65537, rnd.getrandbits(bits),
+                            rnd.getrandbits(half), rnd.getrandbits(half),
+                            rnd.getrandbits(half), rnd.getrandbits(half), rnd.getrandbits(half)])
+
+
+def bench(der, repeat):
+    """ Time parsing der, returning the best time in seconds """
+    return min(timeit.repeat(lambda: privkey_read.readtlvasn1(der, 0, len(der)), number=1, repeat=repeat))
+
+
+def main():
+    fast = privkey_read.octets2int
+    print("{:>6} {:>12} {:>12} {:>9}".format("bits", "loop (ms)", "fast (ms)", "speed-up"))
+    for bits in (4096, 8192, 16384):
+        der = fakekey(bits)
+        privkey_read.octets2int = octets2int_loop
+        t_loop = bench(der, 5)
+        privkey_read.octets2int = fast
+        t_fast = bench(der, 20)
+        print("{:>6} {:>12.3f} {:>12.3f} {:>8.1f}x".format(bits, 1000*t_loop, 1000*t_fast, t_loop/t_fast))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# (C) Nikhef 2019 Mischa Salle
+
+# Benchmark of the k-of-n split and join in privkey_shamir.py against a
+# per-byte implementation, for primes of 1024 to 8192 bits (2048 to 16384
+# bit keys) into n shares.
+#
+# Usage: bench/bench_shamir.py [<n>]
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from privkey_shamir import gfmul, gfdiv, splitsecret, joinsecret
+
+
+def splitloop(secret, k, n):
+    """ Per-byte split: evaluate each byte's polynomial at each x """
+    coeffs = [bytearray(os.urandom(len(secret))) for j in range(k-1)]
+    shares = []
+    for x in range(1, n+1):
+        y = bytearray(len(secret))
+        for b in range(len(secret)):
+            v = 0
+            for c in reversed(coeffs):
+                v = gfmul(v, x) ^ c[b]
+            y[b] = gfmul(v, x) ^ secret[b]
+        shares.append((x, y))
+    return shares
+
+
+def joinloop(shares):
+    """ Per-byte join: Lagrange interpolation at 0 of each byte """
+    xs = [x for (x, y) in shares]
+    secret = bytearray(len(shares[0][1]))
+    for (i, (x, y)) in enumerate(shares):
+        coeff = 1
+        for (j, xj) in enumerate(xs):
+            if(j != i):
+                coeff = gfmul(coeff, gfdiv(xj, xj ^ x))
+        for b in range(len(y)):
+            secret[b] ^= gfmul(y[b], coeff)
+    return secret
+
+
+def bench(func, repeat):
+    """ Time func, returning the best time in seconds """
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    print("{} shares".format(n))
+    print("{:>6} {:>3} {:>12} {:>12} {:>12} {:>12}".format("bits", "k", "split loop", "split (ms)", "join loop", "join (ms)"))
+    for bits in (1024, 2048, 4096, 8192):
+        secret = bytearray(os.urandom(bits // 8))
+        for k in sorted({2, max(2, n // 2), n}):
+            shares = splitsecret(secret, k, n)
+            assert joinsecret(shares[n-k:]) == secret
+            assert joinloop(splitloop(secret, k, n)[0:k]) == secret
+            times = [bench(lambda: splitloop(secret, k, n), 1),
+                     bench(lambda: splitsecret(secret, k, n), 10),
+                     bench(lambda: joinloop(shares[0:k]), 1),
+                     bench(lambda: joinsecret(shares[0:k]), 10)]
+            print("{:>6} {:>3}".format(bits, k) + "".join(" {:>12.3f}".format(1000*t) for t in times))
+
+
+if __name__ == "__main__":
+    main()
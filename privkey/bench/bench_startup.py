@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# (C) Nikhef 2019 Mischa Salle
+
+# Benchmark of the start-up cost of the scripts, which is paid again for
+# every key: the import time of each module as reported by
+# python -X importtime (Python 3.7 or later), and the end-to-end latency
+# of privkey_read.py and privkey_write.py on the example key, against an
+# interpreter doing nothing.  Each is run with the default interpreter
+# flags and with -S -E, as on a minimal install without site-packages.
+#
+# Usage: bench/bench_startup.py [<python>] [<runs>]
+
+import os
+import subprocess
+import sys
+import time
+
+here = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+modules = ['privkey_read', 'privkey_write', 'privkey_split', 'convert', 'convert_revert']
+
+
+def importtime(python, flags, module, runs):
+    """ Return the best cumulative import time of module in microseconds, None when not available """
+    best = None
+    for i in range(runs):
+        out = subprocess.Popen([python]+flags+['-X', 'importtime', '-c', 'import '+module],
+                               cwd=here, stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()[1]
+        for line in out.decode('ASCII', 'replace').splitlines():
+            fields = line.split('|')
+            if(len(fields) == 3 and fields[2].strip() == module):
+                t = int(fields[1])
+                best = t if best is None else min(best, t)
+    return best
+
+
+def latency(python, flags, args, data, runs):
+    """ Return the best end-to-end time in ms of running python with args and data on stdin """
+    best = None
+    for i in range(runs):
+        t = time.time()
+        p = subprocess.Popen([python]+flags+args, cwd=here,
+                             stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        p.communicate(data)
+        t = time.time()-t
+        if(p.returncode != 0):
+            raise RuntimeError("{} failed".format(' '.join(args)))
+        best = t if best is None else min(best, t)
+    return 1000*best
+
+
+def main():
+    python = sys.argv[1] if len(sys.argv) > 1 else sys.executable
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    with open(os.path.join(here, 'example_data', 'privkeyrsa_plain.pem'), mode="rb") as f:
+        key = f.read()
+    parts = subprocess.Popen([python, 'privkey_read.py'], cwd=here,
+                             stdin=subprocess.PIPE, stdout=subprocess.PIPE).communicate(key)[0]
+    for flags in ([], ['-S', '-E']):
+        print("{} {}".format(python, ' '.join(flags)))
+        for module in modules:
+            t = importtime(python, flags, module, runs)
+            if(t is not None):
+                print("{:>32} {:>8.3f} ms".format("import "+module, t/1000.0))
+        print("{:>32} {:>8.3f} ms".format("interpreter start-up", latency(python, flags, ['-c', 'pass'], b'', runs)))
+        print("{:>32} {:>8.3f} ms".format("privkey_read.py", latency(python, flags, ['privkey_read.py'], key, runs)))
+        print("{:>32} {:>8.3f} ms".format("privkey_write.py", latency(python, flags, ['privkey_write.py'], parts, runs)))
+
+
+if __name__ == "__main__":
+    main()
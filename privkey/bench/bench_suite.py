@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# (C) Nikhef 2019 Mischa Salle
+
+# End-to-end benchmark suite for the RCauth private key exchange. For keys
+# of 1024 to 16384 bits it times each stage separately:
+# - PEM decode (pemtoasn) and the full TLV parse (readtlvasn1),
+# - indexing the key and extracting mod, exp and p1 (indexprivkey),
+# - XOR of p1 with two pads and zeroing (xorpads, zero),
+# - reconstruction (mkprivkey), DER encoding (writeseqtlvasn1) and PEM
+#   armour (armourprivkey),
+# - split_key and join_key as a whole,
+# - the convert.py -> convert_revert.py round trip, as separate processes,
+#   reading the key with input_file and writing it with openssl rsa
+#   instead of openssl rsa -des3, so that it needs no pass phrase.
+# It runs offline: the keys are generated once with openssl genrsa and kept
+# in the keys directory (generating a 16384 bit key takes minutes).
+#
+# The results, the best time in seconds per stage and key size, are
+# written as JSON to stdout or with --output to a file.  Each time is the
+# best of repeats runs of at least mintime seconds; the stages take turns,
+# so that a busy moment of the machine slows down one run of each stage
+# rather than all runs of one.  A fixed pure Python workload is timed
+# along with them as 'calibration'.  With --compare <baseline> the results
+# are also compared with an earlier run, with the baseline times scaled
+# by the ratio of the calibrations, flagging every stage that got slower
+# by more than --tolerance (default 10%) and by more than --noise
+# (default 5 microseconds), in which case the exit value is 1; stages of
+# a few microseconds vary by more than 10% from run to run.
+#
+# Usage: bench/bench_suite.py [--sizes <bits>,...] [--keys <dir>] [--output <file>]
+#                             [--compare <baseline>] [--tolerance <fraction>] [--noise <seconds>]
+
+import argparse
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+
+here = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, here)
+
+import privkey_write
+from privkey_read import pemtoasn, readtlvasn1, unwrappkcs8, LazySeqasn1, indexprivkey, keyparts, readpemblocks
+from privkey_write import mkprivkey, writeseqtlvasn1, armourprivkey
+from privkey_split import xorpads, zero, int2bytes, split_key, join_key
+
+sizes = [1024, 2048, 4096, 8192, 16384]
+
+# Minimal time per measurement, repeated to take the best
+mintime = 0.1
+repeats = 9
+
+convertcmd = ("import sys, convert; convert.input_file = sys.argv[1]; "
+              "del sys.argv[1]; sys.exit(convert.main())")
+revertcmd = ("import sys, convert_revert; convert_revert.input_cmd = ['cat', sys.argv[1]]; "
+             "convert_revert.openssl_cmd = ['openssl', 'rsa']; del sys.argv[1]; sys.exit(convert_revert.main())")
+
+
+def genkey(keydir, bits):
+    """ Return the name of the PEM key of bits bits in keydir, generating it if needed """
+    name = os.path.join(keydir, 'rsa{}.pem'.format(bits))
+    if(not os.path.exists(name)):
+        sys.stderr.write("Generating {} bit key...\n".format(bits))
+        with open(os.devnull, 'w') as null:
+            subprocess.check_call(['openssl', 'genrsa', '-out', name+'.tmp', str(bits)], stderr=null)
+        os.rename(name+'.tmp', name)
+    return name
+
+
+def best(funcs):
+    """ Return the best time in seconds of one call of each of funcs, a dict of name to (func, number of calls per run or None) """
+    numbers = {}
+    for (name, (func, number)) in funcs.items():
+        if(number is None):
+            t = timeit.timeit(func, number=1)
+            number = max(1, int(mintime/max(t, 1e-9)))
+        numbers[name] = number
+    times = dict((name, []) for name in funcs)
+    for i in range(repeats):
+        for (name, (func, number)) in sorted(funcs.items()):
+            times[name].append(timeit.timeit(func, number=numbers[name])/numbers[name])
+    return dict((name, min(t)) for (name, t) in times.items())
+
+
+def calibration():
+    """ Fixed pure Python workload, to compare the speed of the machine between runs """
+    return sum(i*i for i in range(1000))
+
+
+def roundtrip(keyfile, padfiles, tmp):
+    """ Split keyfile with convert.py and join it with convert_revert.py, returning the PEM output """
+    split = os.path.join(tmp, 'split')
+    randoms = [padfiles[0], '0', padfiles[1], '0']
+    with open(split, 'wb') as f:
+        subprocess.check_call([sys.executable, '-c', convertcmd, keyfile]+randoms, cwd=here, stdout=f)
+    p = subprocess.Popen([sys.executable, '-c', revertcmd, split]+randoms, cwd=here,
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    (out, err) = p.communicate()
+    if(p.returncode != 0):
+        raise RuntimeError("convert_revert.py failed: {}".format(err.decode('ASCII', 'replace')))
+    return out
+
+
+def benchsize(keyfile, padfiles, pads, tmp):
+    """ Time all stages for the key in keyfile, returning a dict of stage to seconds """
+    with open(keyfile, mode="rb") as f:
+        pem = bytearray(f.read())
+    asn = pemtoasn(pem)
+    # The RSA key itself, also when wrapped in PKCS#8
+    seq = unwrappkcs8(LazySeqasn1(asn, 0, len(asn)))
+    (mod, exp, p1) = keyparts(indexprivkey(asn))
+    p1_bin = int2bytes(p1, (p1.bit_length()+7) // 8)
+    pkey = mkprivkey(mod, exp, p1)
+    der = writeseqtlvasn1(pkey)
+    (m, e, xor) = split_key(asn, pads)
+    if(join_key(mod, exp, xor, pads) != der):
+        raise RuntimeError("join_key does not give back the key")
+    out = roundtrip(keyfile, padfiles, tmp)
+    if(keyparts(indexprivkey(next(readpemblocks(io.BytesIO(out)))[1])) != (mod, exp, p1)):
+        raise RuntimeError("Round trip does not give back the key")
+    scratch = bytearray(len(p1_bin))
+    return best({
+        'calibration': (calibration, None),
+        'pem decode': (lambda: pemtoasn(pem), None),
+        'readtlvasn1': (lambda: readtlvasn1(asn, seq.start, seq.end), None),
+        'indexprivkey': (lambda: keyparts(indexprivkey(asn)), None),
+        'xor': (lambda: xorpads(p1_bin, pads, scratch), None),
+        'zero': (lambda: zero(scratch), None),
+        'mkprivkey': (lambda: mkprivkey(mod, exp, p1), None),
+        'writeseqtlvasn1': (lambda: writeseqtlvasn1(pkey), None),
+        'armour': (lambda: armourprivkey(der), None),
+        'split_key': (lambda: split_key(asn, pads), None),
+        'join_key': (lambda: join_key(mod, exp, xor, pads), None),
+        'roundtrip': (lambda: roundtrip(keyfile, padfiles, tmp), 1),
+    })
+
+
+def compare(results, baseline, tolerance, noise):
+    """ Print the results against the baseline, returning the number of stages slower by more than tolerance and noise """
+    regressions = 0
+    print("{:>6} {:>16} {:>12} {:>12} {:>8}".format("bits", "stage", "baseline", "now", "ratio"))
+    for (bits, stages) in sorted(results.items(), key=lambda item: int(item[0])):
+        # Scale the baseline to the speed of the machine now
+        scale = 1.0
+        if('calibration' in stages and 'calibration' in baseline.get(bits, {})):
+            scale = stages['calibration']/baseline[bits]['calibration']
+            print("{:>6} {:>16} {:>12} {:>12} {:>8.2f}".format(bits, "calibration", "", "", scale))
+        for (stage, t) in sorted(stages.items()):
+            base = baseline.get(bits, {}).get(stage)
+            if(base is None or stage == 'calibration'):
+                continue
+            base *= scale
+            ratio = t/base
+            flag = ""
+            if(ratio > 1+tolerance and t-base > noise):
+                flag = "REGRESSION"
+                regressions += 1
+            print("{:>6} {:>16} {:>9.3f} ms {:>9.3f} ms {:>8.2f} {}".format(bits, stage, 1000*base, 1000*t, ratio, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default=",".join(str(s) for s in sizes),
+                        help="comma separated key sizes in bits (default %(default)s)")
+    parser.add_argument("--keys", metavar="dir", default=os.path.join(here, 'bench', 'keys'),
+                        help="directory for the generated keys (default bench/keys)")
+    parser.add_argument("--output", metavar="file", help="write the JSON results to file")
+    parser.add_argument("--compare", metavar="baseline", help="compare with the JSON results in baseline")
+    parser.add_argument("--tolerance", metavar="fraction", type=float, default=0.1,
+                        help="with --compare, the slowdown flagged as a regression (default %(default)s)")
+    parser.add_argument("--noise", metavar="seconds", type=float, default=5e-6,
+                        help="with --compare, the smallest slowdown in seconds flagged as a regression (default %(default)s)")
+    args = parser.parse_args()
+    if(not os.path.isdir(args.keys)):
+        os.makedirs(args.keys)
+    tmp = tempfile.mkdtemp()
+    try:
+        padfiles = [os.path.join(tmp, 'pad1'), os.path.join(tmp, 'pad2')]
+        pads = []
+        for name in padfiles:
+            pad = bytearray(os.urandom(4096))
+            with open(name, mode="wb") as f:
+                f.write(pad)
+            pads.append((pad, 0))
+        results = {}
+        for bits in [int(s) for s in args.sizes.split(",")]:
+            results[str(bits)] = benchsize(genkey(args.keys, bits), padfiles, pads, tmp)
+    finally:
+        shutil.rmtree(tmp)
+    report = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'powbackend': privkey_write.powbackend,
+        'invbackend': privkey_write.invbackend,
+        'results': results,
+    }
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if(args.output):
+        with open(args.output, 'w') as f:
+            f.write(text+"\n")
+    elif(not args.compare):
+        print(text)
+    if(args.compare):
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if(compare(results, baseline['results'], args.tolerance, args.noise)):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# (C) Nikhef 2019 Mischa Salle
+
+# Benchmark of checkprivkey() in privkey_write.py against spawning
+# openssl rsa -check for every key, for the unencrypted example key or a
+# given unencrypted (PKCS#1 or PKCS#8, PEM or DER) private key, with
+# each of the available modular exponentiation backends.
+#
+# Usage: bench/bench_validate.py [<private-key>]
+
+import os
+import subprocess
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import privkey_write
+from privkey_write import checkprivkey, powbackends, mkprivkey
+from privkey_read import indexprivkey, keyparts
+
+
+def main():
+    if(len(sys.argv) > 1):
+        keyfile = sys.argv[1]
+    else:
+        keyfile = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'example_data', 'privkeyrsa_plain.pem')
+    with open(keyfile, mode="rb") as f:
+        octets = f.read()
+    (mod, exp, p) = keyparts(indexprivkey(bytearray(octets)))
+    pkey = mkprivkey(mod, exp, p)
+    print("{} bit key, {} small primes".format(mod.bit_length(), len(privkey_write.smallprimes)))
+    for rounds in (1, privkey_write.mrrounds, 5):
+        for (name, f) in powbackends:
+            privkey_write.powmod = f
+            t = min(timeit.repeat(lambda: checkprivkey(pkey, rounds), number=1, repeat=5))
+            print("{:>24} {:>8.3f} ms".format("{} rounds, {}".format(rounds, name), 1000*t))
+    cmd = ["openssl", "rsa", "-check", "-noout", "-in", keyfile]
+    if(not octets.startswith(b'-----')):
+        cmd += ["-inform", "DER"]
+    with open(os.devnull, "wb") as null:
+        t = min(timeit.repeat(lambda: subprocess.check_call(cmd, stdout=null, stderr=null), number=1, repeat=5))
+    print("{:>24} {:>8.3f} ms".format("openssl rsa -check", 1000*t))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# (C) Nikhef 2019 Mischa Salle
+
+# Micro-benchmark of the XOR and zeroing of the pads: the per-byte loops
+# formerly in convert.py against xorpads() and zero() in privkey_split.py.
+#
+# Usage: bench/bench_xor.py [<pad-size-in-bytes>]
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from privkey_split import xorpads, zero
+
+
+def xorloop(p1_bin, xordata1, offset1, xordata2, offset2):
+    """ The original per-byte XOR and zeroing """
+    outdata=bytearray(len(p1_bin))
+    for i in range(len(p1_bin)):
+        outdata[i]=p1_bin[i] ^ xordata1[offset1+i] ^ xordata2[offset2+i]
+        p1_bin[i]=0
+    for i in range(len(xordata1)):
+        xordata1[i]=0
+    for i in range(len(xordata2)):
+        xordata2[i]=0
+    return outdata
+
+
+def xorbulk(p1_bin, xordata1, offset1, xordata2, offset2):
+    """ The bulk XOR and zeroing """
+    outdata=xorpads(p1_bin, [(xordata1, offset1), (xordata2, offset2)])
+    zero(p1_bin)
+    zero(xordata1)
+    zero(xordata2)
+    return outdata
+
+
+def bench(func, bits, padsize, repeat):
+    """ Time func for a prime of bits bits, returning the best time in seconds """
+    p1 = bytearray(os.urandom(bits // 8))
+    pad1 = bytearray(os.urandom(padsize))
+    pad2 = bytearray(os.urandom(padsize))
+    times = []
+    for i in range(repeat):
+        # func zeroes its inputs, so each run gets fresh copies
+        args = (bytearray(p1), bytearray(pad1), 7, bytearray(pad2), 11)
+        t = timeit.default_timer()
+        func(*args)
+        times.append(timeit.default_timer()-t)
+    return min(times)
+
+
+def main():
+    padsize = int(sys.argv[1]) if len(sys.argv) > 1 else 1 << 20
+    print("pad size {} bytes".format(padsize))
+    print("{:>6} {:>12} {:>12} {:>9}".format("bits", "loop (ms)", "bulk (ms)", "speed-up"))
+    for bits in (2048, 4096, 8192, 16384):
+        t_loop = bench(xorloop, bits, padsize, 3)
+        t_bulk = bench(xorbulk, bits, padsize, 10)
+        print("{:>6} {:>12.3f} {:>12.3f} {:>8.0f}x".format(bits, 1000*t_loop, 1000*t_bulk, t_loop/t_bulk))
+
+
+if __name__ == "__main__":
+    main()
@@ -20,112 +20,367 @@
 # - extracts mod, exp and p1 from the private key,
 # - XORs the p1 with both randoms using their respective offset
 # - prints mod, exp and XOR-ed p1
+#
+# With --batch <manifest> it does the same for every key listed in the
+# manifest, see privkey_batch.py for its format.
+# With --bundle it does the same for every key in the PEM bundle produced by
+# input_cmd (or input_file), advancing the offsets after each key.
+# With --binary it prints binary frames instead of text, see privkey_write.py.
+# With --archive <file> it appends the frames to an escrow archive instead,
+# see privkey_archive.py, and prints the fingerprints of the keys.
+# With --ledger the offsets may be left out: the next free range of each
+# random file is taken from its ledger, and given offsets are checked against
+# it, see privkey_ledger.py. The offsets used are printed with the key.
+# With --threshold <k> <share-file> ... it does not use random data but
+# splits p1 into one share per share file, any k of which reconstruct it,
+# see privkey_shamir.py.
+# With --ask-pass it asks for the pass phrase of the encrypted keys once and
+# hands it to input_cmd (or batch_input_cmd) with -passin fd:<n>.
 
+import os
 import sys
-import binascii
-import subprocess
+import atexit
 from subprocess import PIPE, Popen, CalledProcessError
 
+import privkey_stats
+from privkey_split import parserandoms, openrandoms, closepads, dumpsplit, unpacksplit, binarystdout, zero
+from privkey_openssl import readpassphrase, passphrasepipe, passfds, checkoutput
+from privkey_ledger import openledgers, split_key_ledger
+
 # Input command:
 # should read the private key and dump it on stdout:
 input_cmd=["openssl", "rsa", "-in", "example_data/privkeyrsa.pem"]
 
-# path to privkey_read.py tool
-privkey_read="./privkey_read.py"
-
-
-# Check cmdline args: optionally one random can be input via stdin
-if ( len(sys.argv)!=3 and len(sys.argv)!=5 ):
-    sys.stderr.write("Usage: <random-file> <offset> [<random-file> <offset>]\n")
-    sys.exit(1)
-
-# First random, always file
-try:
-    # First try as ascii file, if that fails, try as binary
-    with open(sys.argv[1]) as f:
-        xordata1 = bytearray(bytearray(f.read().strip(), "ASCII").decode("hex"))
-        #sys.stderr.write("Input 1 is ascii\n");
-except UnicodeDecodeError:
-    # Try as binary instead
-    with open(sys.argv[1], mode="rb") as f:
-        xordata1 = bytearray(f.read())
-        #sys.stderr.write("Input 1 is binary\n");
-# offset in xordata1
-offset1=int(sys.argv[2])
-
-# Second offset/random: either file or stdin (then offset==0)
-if (len(sys.argv) == 3):
-    # Read second random from stdin
-    sys.stderr.write("Enter second random: ")
-    xordata2 = bytearray(bytearray(sys.stdin.readline().strip(), "ASCII").decode("hex"))
-    offset2=0
-else:
-    # Read second random from file
+# Input file:
+# set to an unencrypted private key (PKCS#1 or PKCS#8, PEM or DER) to read it
+# directly instead of running input_cmd
+input_file=None
+
+# Batch input command:
+# the key source from the manifest is appended, set to None to read the key
+# sources directly as unencrypted (PKCS#1 or PKCS#8) private keys
+batch_input_cmd=["openssl", "rsa", "-in"]
+
+# Audit log:
+# set to a file to record every split key (fingerprint, random data ranges
+# and time) in an append-only Merkle tree log, see privkey_audit.py
+audit_log=None
+
+# Ledger directory:
+# with --ledger, keep the ledgers of the random files here, None to keep
+# <random-file>.ledger next to each random file
+ledger_dir=None
+
+
+def parseargs():
+    """ Parse the cmdline args: optionally one random can be input via stdin """
+    import argparse
+    parser = argparse.ArgumentParser(
+        usage="%(prog)s [--binary | --archive <file>] [--bundle] <random-file> <offset> [<random-file> <offset>]\n"
+              "       %(prog)s [--binary | --archive <file>] [--bundle] --ledger <random-file> [<offset>] [<random-file> [<offset>]]\n"
+              "       %(prog)s [--binary | --archive <file>] [--ledger] --batch <manifest>\n"
+              "       %(prog)s [--binary] --threshold <k> <share-file> <share-file> [...]")
+    parser.add_argument("--binary", action="store_true",
+                        help="print binary frames instead of mod=, exp= and XOR= lines")
+    parser.add_argument("--archive", metavar="file",
+                        help="append the split keys to an escrow archive")
+    parser.add_argument("--batch", metavar="manifest",
+                        help="split all keys listed in manifest")
+    parser.add_argument("--bundle", action="store_true",
+                        help="split all keys in the PEM bundle from input_cmd, "
+                             "advancing the offsets after each key")
+    parser.add_argument("--ledger", action="store_true",
+                        help="take the offsets from, and record them in, "
+                             "the ledgers of the random files")
+    parser.add_argument("--threshold", metavar="k", type=int,
+                        help="split into shares written to the given files, "
+                             "any k of which reconstruct the key")
+    parser.add_argument("--ask-pass", action="store_true",
+                        help="ask for the pass phrase of the encrypted keys once")
+    parser.add_argument("--stats", action="store_true",
+                        help="print the time spent in each stage as JSON on stderr")
+    parser.add_argument("--stats-memory", action="store_true",
+                        help="with --stats, also the peak memory of each stage")
+    parser.add_argument("randoms", nargs="*", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.threshold is not None:
+        if args.batch is not None or args.bundle or args.ledger or args.archive is not None or \
+           args.threshold<2 or len(args.randoms)<args.threshold:
+            parser.print_usage(sys.stderr)
+            sys.exit(1)
+        return args
+    if args.batch is not None:
+        if len(args.randoms)!=0 or args.bundle:
+            parser.print_usage(sys.stderr)
+            sys.exit(1)
+        return args
+    try:
+        args.randoms=parserandoms(args.randoms, not args.ledger)
+    except ValueError as e:
+        sys.stderr.write("Error: %s\n" % e)
+        parser.print_usage(sys.stderr)
+        sys.exit(1)
+    if len(args.randoms)!=1 and len(args.randoms)!=2:
+        parser.print_usage(sys.stderr)
+        sys.exit(1)
+    return args
+
+
+def openarchive(filename):
+    """ Return the escrow archive in filename, or None without one """
+    if filename is None:
+        return None
+    from privkey_archive import Archive
+    return Archive(filename)
+
+
+def storeframe(archive, frame, label=None):
+    """ Append the binary frame of a split key to the archive, printing its fingerprint """
+    from privkey_archive import fingerprint, hexfingerprint
+    (mod, exp, xor, fields, offs)=unpacksplit(frame)
+    zero(xor)
+    fp=fingerprint(mod, exp)
+    archive.append(fp, frame)
+    if label is not None:
+        sys.stdout.write("key=%s fingerprint=%s\n" % (label, hexfingerprint(fp)))
+    else:
+        sys.stdout.write("fingerprint=%s\n" % hexfingerprint(fp))
+    sys.stdout.flush()
+
+
+def writesplit(archive, mod, exp, outdata, binary, label=None, offsets=None, tag=None):
+    """ Write a split key to stdout, or to the archive when there is one """
+    result_bin=dumpsplit(mod, exp, outdata, binary or archive is not None, label, offsets, tag)
+    if archive is not None:
+        storeframe(archive, result_bin, label)
+    else:
+        out=binarystdout()
+        out.write(result_bin)
+        out.flush()
+    zero(result_bin)
+
+
+def auditsplit(mod, exp, pads, offsets, length):
+    """ Record a split key in the audit log, if there is one """
+    if audit_log is not None:
+        from privkey_audit import record
+        record(audit_log, "split", mod, exp, zip([pad for (pad, o) in pads], offsets), length)
+
+
+def dobatch(manifest, binary, archive, ledger, passphrase=None):
+    """ Split all keys in manifest, printing the records (or storing them in the archive) in order, returning the exit value """
+    from privkey_batch import readmanifest, runbatch, splitrecord
+    try:
+        records = readmanifest(manifest, not ledger)
+    except (IOError, ValueError) as e:
+        sys.stderr.write("ERROR: %s\n" % e)
+        return 1
+    failed = 0
+    out = binarystdout()
+    binary=binary or archive is not None
+    for (record, output, error) in runbatch(splitrecord, [(r, batch_input_cmd, binary, ledger, ledger_dir, audit_log, passphrase) for r in records]):
+        if error is not None:
+            sys.stderr.write("ERROR: %s:%d: %s: %s\n" %
+                             (manifest, record.lineno, record.source, error))
+            failed += 1
+            continue
+        if archive is not None:
+            storeframe(archive, output, record.source)
+        else:
+            out.write(output)
+            out.flush()
+    if failed:
+        sys.stderr.write("%d of %d keys failed\n" % (failed, len(records)))
+        return 1
+    return 0
+
+
+def inputpipe(passphrase=None):
+    """ Start input_cmd, returning it as a Popen object with stdout as pipe; the pass phrase is handed over with -passin fd:<n> """
+    if passphrase is None:
+        return Popen(input_cmd, stdout=PIPE, close_fds=True)
+    fd=passphrasepipe(passphrase)
+    try:
+        return Popen(input_cmd+['-passin', 'fd:%d' % fd], stdout=PIPE, **passfds(fd))
+    finally:
+        os.close(fd)
+
+
+def waitinput(pipe):
+    """ Wait for input_cmd to exit, returning its exit value """
+    return pipe.wait()
+
+
+def dobundle(pads, ledgers, binary, archive, passphrase=None):
+    """ Split each key of the PEM bundle from input_cmd as soon as its block is read, returning the exit value """
+    from privkey_read import readpemblocks
+    nkeys=0
+    failed=False
+    pipe=None
+    try:
+        if input_file is not None:
+            f=open(input_file, mode="rb")
+        else:
+            pipe=inputpipe(passphrase)
+            f=pipe.stdout
+    except (IOError, OSError) as e:
+        sys.stderr.write("ERROR: %s\n" % e)
+        return 1
+    try:
+        for (what, der) in readpemblocks(f):
+            if what not in ("RSA PRIVATE KEY", "PRIVATE KEY"):
+                sys.stderr.write("Warning, skipping '%s'\n" % what)
+                continue
+            if der is None:
+                raise ValueError("Private key is encrypted")
+            (mod, exp, outdata, offsets, tag)=split_key_ledger(der, pads, ledgers)
+            zero(der)
+            auditsplit(mod, exp, pads, offsets, len(outdata))
+            writesplit(archive, mod, exp, outdata, binary, label=str(nkeys+1),
+                       offsets=offsets, tag=tag)
+            # The next key uses the random data right after this one, or
+            # the next free range of the ledger when no offset was given
+            pads=[(pad, offset if offset is None else used+len(outdata))
+                  for ((pad, offset), used) in zip(pads, offsets)]
+            zero(outdata)
+            nkeys+=1
+    except (IOError, ValueError, IndexError, RuntimeError) as e:
+        sys.stderr.write("ERROR: key %d: %s\n" % (nkeys+1, e))
+        failed=True
+    finally:
+        f.close()
+        if pipe is not None:
+            waitinput(pipe)
+    if pipe is not None and pipe.returncode != 0:
+        sys.stderr.write("ERROR: exitval %s\n" % pipe.returncode)
+        return 1
+    return 1 if failed else 0
+
+
+def dothreshold(k, sharefiles, binary, passphrase=None):
+    """ Split the key from input_cmd into shares, one per share file, returning the exit value """
+    from privkey_shamir import split_key_shares, dumpshare
+    try:
+        if input_file is not None:
+            with open(input_file, mode="rb") as f:
+                key=f.read()
+        else:
+            key=checkoutput(input_cmd, passphrase)
+        (mod, exp, shares, tag)=split_key_shares(key, k, len(sharefiles))
+    except (IOError, ValueError, IndexError, RuntimeError) as e:
+        sys.stderr.write("ERROR: %s\n" % e)
+        return 1
+    except CalledProcessError as e:
+        sys.stderr.write("ERROR: %s, exitval %s\n" %
+                         (e.output, e.returncode))
+        return 1
+    files=[]
+    failed=True
+    try:
+        # Shares are secret: never overwrite, readable by the owner only.
+        # All share files are created before the first share is written
+        for sharefile in sharefiles:
+            files.append(os.fdopen(os.open(sharefile, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), "wb"))
+        for (f, (x, y)) in zip(files, shares):
+            share_bin=dumpshare(mod, exp, x, k, y, tag, binary)
+            try:
+                f.write(share_bin)
+                f.flush()
+            finally:
+                zero(share_bin)
+        failed=False
+    except (IOError, OSError) as e:
+        sys.stderr.write("ERROR: %s\n" % e)
+    finally:
+        for f in files:
+            try:
+                f.close()
+            except (IOError, OSError) as e:
+                if not failed:
+                    sys.stderr.write("ERROR: %s\n" % e)
+                failed=True
+        if failed:
+            # Do not leave an incomplete set of shares behind
+            for sharefile in sharefiles[:len(files)]:
+                os.unlink(sharefile)
+        for (x, y) in shares:
+            zero(y)
+    return 1 if failed else 0
+
+
+def main():
+    args = parseargs()
+    if args.stats:
+        privkey_stats.enable(args.stats_memory)
+        atexit.register(privkey_stats.report)
+    passphrase=None
+    if args.ask_pass:
+        try:
+            passphrase=readpassphrase()
+            atexit.register(zero, passphrase)
+        except (EOFError, ValueError) as e:
+            sys.stderr.write("ERROR: %s\n" % e)
+            return 1
+    if args.threshold is not None:
+        return dothreshold(args.threshold, args.randoms, args.binary, passphrase)
+    archive = openarchive(args.archive)
+    if args.batch is not None:
+        return dobatch(args.batch, args.binary, archive, args.ledger, passphrase)
+
+    # Randoms: first always file (ascii or binary), only the needed part is
+    # read, second either file or stdin (then offset==0)
+    try:
+        pads=openrandoms(args.randoms)
+    except (IOError, ValueError) as e:
+        sys.stderr.write("Error: %s\n" % e)
+        return 1
+    if args.ledger:
+        ledgers=openledgers(pads, ledger_dir)
+    else:
+        ledgers=[None]*len(pads)
+
+    if args.bundle:
+        try:
+            return dobundle(pads, ledgers, args.binary, archive, passphrase)
+        finally:
+            closepads(pads)
+
+    # Read private key
     try:
-        # First try as ascii file, if that files, try as binary
-        with open(sys.argv[3]) as f:
-            xordata2 = bytearray(bytearray(f.read().strip(), "ASCII").decode("hex"))
-            #sys.stderr.write("Input 2 is ascii\n");
-    except UnicodeDecodeError:
-        # Try as binary
-        with open(sys.argv[3], mode="rb") as f:
-            xordata2 = bytearray(f.read())
-            #sys.stderr.write("Input 2 is binary\n");
-    # offset in xordata2
-    offset2=int(sys.argv[4])
-
-# Verify that both xordata aren't the same
-if (xordata1 == xordata2):
-    sys.stderr.write("Error: both sets of random data are the same!\n")
-    sys.exit(1)
-
-# Read private key
-try:
-    key=subprocess.check_output(input_cmd)
-except CalledProcessError as e:
-    sys.stderr.write("ERROR: %s, exitval %s\n" %
-                     (e.output, e.returncode))
-    sys.exit(1)
-
-# Get params from private key
-try:
-    pipe=subprocess.Popen(privkey_read,
-                          stdin=PIPE,
-                          stdout=PIPE,
-                          close_fds=True)
-    (result, err)=pipe.communicate(input=key)
-except CalledProcessError as e:
-    sys.stderr.write("ERROR: exitval %s\n" %
-                     (e.returncode))
-
-# result is string with 3 lines: mod, exp and p1
-# unfortunately, we can't really cleanup result or params
-params=result.decode('ASCII').split('\n')
-
-# First and second lines contain mod and exp
-mod=params[0][4:]
-exp=params[1][4:]
-
-# Create p1_bin as bytearray so that we can overwrite
-p1_bin=bytearray(binascii.unhexlify(params[2][4:]))
-
-# Create output bytearray
-outdata=bytearray(len(p1_bin))
-# do the actual xor-in
-for i in range(len(p1_bin)):
-    outdata[i]=p1_bin[i] ^ xordata1[offset1+i] ^ xordata2[offset2+i]
-    # Clear input data
-    p1_bin[i]=0
-for i in range(len(xordata1)):
-    xordata1[i]=0
-for i in range(len(xordata2)):
-    xordata2[i]=0
-
-result_bin=bytearray(binascii.hexlify(outdata))
-print("mod=%s" % mod)
-print("exp=%s" % exp)
-print("XOR=%s" % result_bin.decode('ASCII'))
-
-# Clear result array
-for i in range(len(result_bin)):
-    result_bin[i]=0
+        if input_file is not None:
+            with open(input_file, mode="rb") as f:
+                key=f.read()
+        else:
+            key=checkoutput(input_cmd, passphrase)
+    except IOError as e:
+        sys.stderr.write("ERROR: %s\n" % e)
+        closepads(pads)
+        return 1
+    except CalledProcessError as e:
+        sys.stderr.write("ERROR: %s, exitval %s\n" %
+                         (e.output, e.returncode))
+        closepads(pads)
+        return 1
+
+    # Get params from private key and do the actual xor-in
+    try:
+        (mod, exp, outdata, offsets, tag)=split_key_ledger(key, pads, ledgers)
+        auditsplit(mod, exp, pads, offsets, len(outdata))
+    except (IOError, ValueError, IndexError, RuntimeError) as e:
+        sys.stderr.write("ERROR: %s\n" % e)
+        return 1
+    finally:
+        # Clear input data
+        closepads(pads)
+
+    # Only with a ledger the offsets are not known beforehand
+    writesplit(archive, mod, exp, outdata, args.binary,
+               offsets=offsets if args.ledger else None, tag=tag)
+
+    # Clear result array
+    zero(outdata)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -20,124 +20,339 @@
 # - XORs the XOR-ed p1 with both randoms using their respective offset,
 # - re-assembles an unencrypted private key from mod, exp and p1,
 # - converts the unencrypted private key to DES3 private key and prints it
+#
+# With --batch <manifest> it does the same for every key listed in the
+# manifest, see privkey_batch.py for its format.
+# With --archive <file> it reads the XOR-ed key(s) from an escrow archive
+# instead of input_cmd, by fingerprint, see privkey_archive.py.
+# With --ledger the offsets may be left out, they are then taken from the
+# offsets recorded with the XOR-ed key (see convert.py --ledger).
+# With --search-offsets <window> it first looks for the offsets, within
+# window bytes of the given ones, at which the pads give a prime of the
+# key, see privkey_search.py.
+# With --validate each reconstructed key is checked in-process:
+# trial division and Miller-Rabin on the primes, and a CRT sign/verify
+# round trip, see checkprivkey() in privkey_write.py.
+# With --threshold <share-file> ... it reads no XOR-ed key or random data,
+# but joins the shares written by convert.py --threshold.
+# With --ask-pass it asks for the pass phrase of the encrypted keys once and
+# hands it to openssl_cmd with -passout fd:<n>; with --batch the keys are
+# then encrypted by up to --jobs openssl processes at a time, see
+# privkey_opensslpool.py (Python 3.5 or later, otherwise one at a time).
+# Without --ask-pass openssl prompts for it, for one key at a time.
 
+import os
 import sys
-import binascii
+import atexit
 import subprocess
 from subprocess import PIPE, Popen, CalledProcessError
 
+import privkey_stats
+from privkey_split import parserandoms, openrandoms, recordedoffsets, closepads, loadsplitrecord, join_key, binarystdout, zero
+from privkey_openssl import readpassphrase, passphrasepipe, passfds
+from privkey_write import armourprivkey, mrrounds
+
 # Input command:
-# should print mod, exp and xor-ed data on stdout, output of something like:
+# should print mod, exp and xor-ed data (text or binary) on stdout, output of
+# something like:
 # ./convert.py example_data/random_asc 10 example_data/random_bin 10
 input_cmd=["cat", "xor_data"]
 
-# path to privkey_write.py tool
-privkey_write="./privkey_write.py"
-
 # openssl cmd to convert unencrypted private key (output of privkey_write.py) in
 # des3 encrypted
 openssl_cmd=["openssl", "rsa", "-des3"]
 
+# Audit log:
+# set to a file to record every reconstructed key (fingerprint, random data
+# ranges and time) in an append-only Merkle tree log, see privkey_audit.py
+audit_log=None
+
+
+def parseargs():
+    """ Parse the cmdline args: optionally one random can be input via stdin """
+    import argparse
+    parser = argparse.ArgumentParser(
+        usage="%(prog)s [--archive <file> --fingerprint <hex>] <random-file> <offset> [<random-file> <offset>]\n"
+              "       %(prog)s [--archive <file> --fingerprint <hex>] --ledger <random-file> [<offset>] [<random-file> [<offset>]]\n"
+              "       %(prog)s [--archive <file> --fingerprint <hex>] [--ledger] --search-offsets <window> [--search-pad <n>] <random-file> <offset> [<random-file> <offset>]\n"
+              "       %(prog)s [--archive <file>] [--ledger] --batch <manifest>\n"
+              "       %(prog)s --threshold <share-file> <share-file> [...]")
+    parser.add_argument("--batch", metavar="manifest",
+                        help="reconstruct all keys listed in manifest")
+    parser.add_argument("--archive", metavar="file",
+                        help="read the keys from an escrow archive")
+    parser.add_argument("--fingerprint", metavar="hex",
+                        help="fingerprint of the key to read from the archive")
+    parser.add_argument("--ledger", action="store_true",
+                        help="take left out offsets from the XOR-ed key")
+    parser.add_argument("--search-offsets", metavar="window", type=int,
+                        help="search the offsets within window bytes of the given ones")
+    parser.add_argument("--search-pad", metavar="n", type=int, action="append",
+                        help="with --search-offsets, search the offset of pad n "
+                             "(1 or 2), by default each pad in turn; giving both "
+                             "searches all combinations")
+    parser.add_argument("--validate", action="store_true",
+                        help="validate each reconstructed key in-process")
+    parser.add_argument("--rounds", metavar="n", type=int, default=mrrounds,
+                        help="with --validate, the number of Miller-Rabin "
+                             "rounds for each prime (default %(default)d)")
+    parser.add_argument("--threshold", action="store_true",
+                        help="join the key from the given share files")
+    parser.add_argument("--ask-pass", action="store_true",
+                        help="ask for the pass phrase of the encrypted keys once")
+    parser.add_argument("--jobs", metavar="n", type=int,
+                        help="with --batch and --ask-pass, the number of "
+                             "openssl processes to run at a time (default: "
+                             "the number of CPUs)")
+    parser.add_argument("--stats", action="store_true",
+                        help="print the time spent in each stage as JSON on stderr")
+    parser.add_argument("--stats-memory", action="store_true",
+                        help="with --stats, also the peak memory of each stage")
+    parser.add_argument("randoms", nargs="*", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.jobs is not None and (args.jobs < 1 or (args.jobs > 1 and not args.ask_pass)):
+        # Without --ask-pass every openssl process prompts on the terminal
+        sys.stderr.write("Error: --jobs must be 1 without --ask-pass\n")
+        parser.print_usage(sys.stderr)
+        sys.exit(1)
+    if args.threshold:
+        if args.batch is not None or args.archive is not None or args.ledger or \
+           args.search_offsets is not None or len(args.randoms)<2:
+            parser.print_usage(sys.stderr)
+            sys.exit(1)
+        return args
+    if (args.batch is not None and (len(args.randoms)!=0 or args.fingerprint is not None or args.search_offsets is not None)) or \
+       (args.search_pad is not None and args.search_offsets is None) or \
+       (args.batch is None and (args.archive is None) != (args.fingerprint is None)):
+        parser.print_usage(sys.stderr)
+        sys.exit(1)
+    if args.batch is not None:
+        return args
+    try:
+        args.randoms=parserandoms(args.randoms, not args.ledger)
+    except ValueError as e:
+        sys.stderr.write("Error: %s\n" % e)
+        parser.print_usage(sys.stderr)
+        sys.exit(1)
+    if (len(args.randoms)!=1 and len(args.randoms)!=2) or \
+       (args.search_pad is not None and any(n!=1 and n!=2 for n in args.search_pad)):
+        parser.print_usage(sys.stderr)
+        sys.exit(1)
+    return args
+
+
+def findoffsets(mod, xor_bin, pads, window, searchpads):
+    """ Search for the offsets of the pads that give a prime of the key, returning the new pads or None """
+    from privkey_search import searchoffsets
+    if searchpads is None:
+        # Most likely only one offset is off: try each pad on its own
+        searches=[[i] for i in range(len(pads))]
+    else:
+        searches=[sorted(set(n-1 for n in searchpads))]
+    for searched in searches:
+        offsets=searchoffsets(mod, xor_bin, pads, searched, window)
+        if offsets is not None:
+            sys.stderr.write("Found offsets: %s\n" % " ".join(str(offset) for offset in offsets))
+            return [(pad, offset) for ((pad, o), offset) in zip(pads, offsets)]
+    sys.stderr.write("ERROR: no offsets within %d bytes give a prime of the key\n" % window)
+    return None
 
-# Check cmdline args: optionally one random can be input via stdin
-if ( len(sys.argv)!=3 and len(sys.argv)!=5 ):
-    sys.stderr.write("Usage: <random-file> <offset> [<random-file> <offset>]\n")
-    sys.exit(1)
-
-# First random, always file
-try:
-    # First try as ascii file, if that fails, try as binary
-    with open(sys.argv[1]) as f:
-        xordata1 = bytearray(bytearray(f.read().strip(), "ASCII").decode("hex"))
-except UnicodeDecodeError:
-    # Try as binary instead
-    with open(sys.argv[1], mode="rb") as f:
-        xordata1 = bytearray(f.read())
-# offset in xordata1
-offset1=int(sys.argv[2])
-
-# Second offset/random: either file or stdin (then offset==0)
-if (len(sys.argv) == 3):
-    # Read second random from stdin
-    sys.stderr.write("Enter second random: ")
-    xordata2 = bytearray(bytearray(sys.stdin.readline().strip(), "ASCII").decode("hex"))
-    offset2=0
-else:
-    # Read second random from file
+
+def encryptkey(key, passphrase=None):
+    """ Convert the unencrypted key (PEM octets) into an encrypted private key, returning None on error """
+    cmd=openssl_cmd
+    fdargs={'close_fds': True}
+    fd=None
+    try:
+        if passphrase is not None:
+            fd=passphrasepipe(passphrase)
+            cmd=openssl_cmd+['-passout', 'fd:%d' % fd]
+            fdargs=passfds(fd)
+        pipe=subprocess.Popen(cmd,
+                              stdin=PIPE,
+                              stdout=PIPE,
+                              **fdargs)
+        (key_enc, err)=pipe.communicate(input=key)
+    except OSError as e:
+        sys.stderr.write("ERROR: %s\n" % e)
+        return None
+    finally:
+        if fd is not None:
+            os.close(fd)
+    if pipe.returncode != 0:
+        sys.stderr.write("ERROR: exitval %s\n" %
+                         (pipe.returncode))
+        return None
+    return key_enc
+
+
+def armouredkeys(results):
+    """ Turn the (record, der, error) results of joinrecord into (record, PEM key, error) """
+    for (record, der, error) in results:
+        key = None
+        if error is None:
+            key = armourprivkey(der)
+            zero(der)
+        yield (record, key, error)
+
+
+def dobatch(manifest, archive, ledger, rounds, passphrase=None, jobs=None):
+    """ Reconstruct all keys in manifest, printing them in order, returning the exit value """
+    from privkey_batch import readmanifest, runbatch, joinrecord
     try:
-        # First try as ascii file, if that files, try as binary
-        with open(sys.argv[3]) as f:
-            xordata2 = bytearray(bytearray(f.read().strip(), "ASCII").decode("hex"))
-    except UnicodeDecodeError:
-        # Try as binary
-        with open(sys.argv[3], mode="rb") as f:
-            xordata2 = bytearray(f.read())
-    # offset in xordata2
-    offset2=int(sys.argv[4])
-
-# Verify that both xordata aren't the same
-if (xordata1 == xordata2):
-    sys.stderr.write("Error: both sets of random data are the same!\n")
-    sys.exit(1)
-
-# Read XOR-ed input key
-try:
-    input_data=subprocess.check_output(input_cmd)
-except CalledProcessError as e:
-    sys.stderr.write("ERROR: %s, exitval %s\n" %
-                     (e.output, e.returncode))
-    sys.exit(1)
-# split input data on newlines
-input_lines=input_data.decode('ASCII').split('\n')
-
-# First and second lines contain mod and exp
-mod=input_lines[0][4:]
-exp=input_lines[1][4:]
-
-# XOR-ed data is third line (as hex)
-xor_bin=bytearray(binascii.unhexlify(input_lines[2][4:]))
-# Create output bytearray of right length
-outdata=bytearray(len(xor_bin))
-# do the actual xor-in
-for i in range(len(xor_bin)):
-    outdata[i]=xor_bin[i] ^ xordata1[offset1+i] ^ xordata2[offset2+i]
-    # Clear input data
-    xor_bin[i]=0
-for i in range(len(xordata1)):
-    xordata1[i]=0
-for i in range(len(xordata2)):
-    xordata2[i]=0
-
-# p1 is hex representation of binary XOR-ed data
-p1=binascii.hexlify(outdata).decode('ASCII')
-
-# Need to write mod, exp and p1 as stdin to privkey_write
-# Note: str.format is tricky for python2/python3, better just use +
-privkey_inp="mod="+mod+"\nexp="+exp+"\n p1="+p1+"\n"
-
-# Convert params back into unencrypted key (in result)
-try:
-    pipe=subprocess.Popen(privkey_write,
-                          stdin=PIPE,
-                          stdout=PIPE,
-                          close_fds=True)
-    # Note: bytes(privkey_inp... is tricky since python3 wants encoding while
-    # python2 not, encode is fine for both
-    (key, err)=pipe.communicate(input=privkey_inp.encode())
-except CalledProcessError as e:
-    sys.stderr.write("ERROR: exitval %s\n" %
-                     (e.returncode))
-
-# Now convert to unencrypted key in result into encrypted private key
-try:
-    pipe=subprocess.Popen(openssl_cmd,
-                          stdin=PIPE,
-                          stdout=PIPE,
-                          close_fds=True)
-    # Note: bytes(inp... is tricky since 3 wants encoding and 2 not, encode is
-    # fine for both
-    (key_enc, err)=pipe.communicate(input=key)
-except CalledProcessError as e:
-    sys.stderr.write("ERROR: exitval %s\n" %
-                     (e.returncode))
-print(key_enc.decode('ASCII'))
+        records = readmanifest(manifest, not ledger)
+    except (IOError, ValueError) as e:
+        sys.stderr.write("ERROR: %s\n" % e)
+        return 1
+    out = binarystdout()
+    failed = [0]
+
+    def emit(record, key_enc, error):
+        if error is not None:
+            sys.stderr.write("ERROR: %s:%d: %s: %s\n" %
+                             (manifest, record.lineno, record.source, error))
+            failed[0] += 1
+            return
+        out.write(key_enc)
+        out.flush()
+
+    if passphrase is None:
+        # openssl prompts for the pass phrase itself, one process at a time
+        jobs = 1
+    keys = armouredkeys(runbatch(joinrecord, [(r, archive, rounds, audit_log) for r in records]))
+    if sys.version_info >= (3, 5) and jobs != 1:
+        # Encrypt the keys concurrently, while the next ones are joined
+        from privkey_opensslpool import runpipeline
+        runpipeline(keys, openssl_cmd, emit, passphrase, '-passout', jobs)
+    else:
+        for (record, key, error) in keys:
+            key_enc = None
+            if error is None:
+                key_enc = encryptkey(key, passphrase)
+                zero(key)
+                if key_enc is None:
+                    error = "%s failed" % openssl_cmd[0]
+            emit(record, key_enc, error)
+    if failed[0]:
+        sys.stderr.write("%d of %d keys failed\n" % (failed[0], len(records)))
+        return 1
+    return 0
+
+
+def dothreshold(sharefiles, rounds):
+    """ Join the key from the shares in sharefiles, returning the unencrypted PEM key or None on error """
+    from privkey_shamir import loadshare, joinshares
+    from privkey_split import assemble_key
+    loaded=[]
+    try:
+        for sharefile in sharefiles:
+            with open(sharefile, mode="rb") as f:
+                loaded.append(loadshare(f.read()))
+        (mod, exp, p1_bin, tag)=joinshares(loaded)
+        der=assemble_key(mod, exp, p1_bin, tag, rounds)
+        key=armourprivkey(der)
+        zero(der)
+        return key
+    except (IOError, ValueError, ArithmeticError, RuntimeError) as e:
+        sys.stderr.write("ERROR: %s\n" % e)
+        return None
+    finally:
+        for l in loaded:
+            zero(l[4])
+
+
+def main():
+    args = parseargs()
+    if args.stats:
+        privkey_stats.enable(args.stats_memory)
+        atexit.register(privkey_stats.report)
+    passphrase=None
+    if args.ask_pass:
+        try:
+            passphrase=readpassphrase(confirm=True)
+            atexit.register(zero, passphrase)
+        except (EOFError, ValueError) as e:
+            sys.stderr.write("ERROR: %s\n" % e)
+            return 1
+    if args.threshold:
+        key=dothreshold(args.randoms, args.rounds if args.validate else None)
+        if key is None:
+            return 1
+        key_enc=encryptkey(key, passphrase)
+        zero(key)
+        if key_enc is None:
+            return 1
+        print(key_enc.decode('ASCII'))
+        return 0
+    archive = None
+    if args.archive is not None:
+        from privkey_archive import Archive
+        archive = Archive(args.archive)
+    if args.batch is not None:
+        return dobatch(args.batch, archive, args.ledger,
+                       args.rounds if args.validate else None,
+                       passphrase, args.jobs)
+
+    # Read XOR-ed input key
+    try:
+        if archive is not None:
+            from privkey_archive import parsefingerprint
+            input_data=archive.read(parsefingerprint(args.fingerprint))
+        else:
+            input_data=subprocess.check_output(input_cmd)
+    except (IOError, LookupError, ValueError) as e:
+        sys.stderr.write("ERROR: %s\n" % e)
+        return 1
+    except CalledProcessError as e:
+        sys.stderr.write("ERROR: %s, exitval %s\n" %
+                         (e.output, e.returncode))
+        return 1
+    # mod, exp and XOR-ed data, either as three lines (hex) or a binary frame
+    try:
+        (mod, exp, xor_bin, offsets, tag)=loadsplitrecord(input_data)
+    except ValueError as e:
+        sys.stderr.write("ERROR: %s\n" % e)
+        return 1
+
+    # Randoms: first always file (ascii or binary), only the needed part is
+    # read, second either file or stdin (then offset==0)
+    try:
+        pads=openrandoms(recordedoffsets(args.randoms, offsets))
+    except (IOError, ValueError) as e:
+        sys.stderr.write("Error: %s\n" % e)
+        zero(xor_bin)
+        return 1
+
+    # XOR the input with the randoms and convert params back into unencrypted key
+    try:
+        if args.search_offsets is not None:
+            found=findoffsets(mod, xor_bin, pads, args.search_offsets, args.search_pad)
+            if found is None:
+                return 1
+            pads=found
+        der=join_key(mod, exp, xor_bin, pads, tag,
+                     args.rounds if args.validate else None)
+        if audit_log is not None:
+            from privkey_audit import record
+            record(audit_log, "join", mod, exp, pads, len(xor_bin))
+        key=armourprivkey(der)
+        zero(der)
+    except (IOError, ValueError, ArithmeticError, RuntimeError) as e:
+        sys.stderr.write("ERROR: %s\n" % e)
+        return 1
+    finally:
+        # Clear input data
+        zero(xor_bin)
+        closepads(pads)
+
+    # Now convert to unencrypted key in result into encrypted private key
+    key_enc=encryptkey(key, passphrase)
+    zero(key)
+    if key_enc is None:
+        return 1
+    print(key_enc.decode('ASCII'))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
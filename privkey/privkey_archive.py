@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# (C) Nikhef 2019 Mischa Salle
+
+# Escrow archive for the RCauth private key exchange. It
+# - appends split keys, as binary frames (see privkey_write.py), to a data
+#   file,
+# - keeps an index <archive>.idx from key fingerprint to frame,
+# - finds a key by its fingerprint without reading the whole archive.
+#
+# The fingerprint of a key is the SHA-256 of the DER encoded public key
+# (the PKCS#1 RSAPublicKey SEQUENCE of modulus and exponent).
+#
+# The index is a header of magic and the number of sorted entries,
+# followed by fixed size entries of fingerprint, frame offset and frame
+# length.  The first entries are sorted by fingerprint and are searched
+# by bisection on the memory-mapped file; entries appended since the last
+# merge form a short unsorted tail that is scanned.  When the tail grows
+# beyond tailmax entries, it is merged into the sorted part.
+#
+# Writers hold an exclusive lock on the data file while appending and
+# merging, readers a shared one while looking up and reading a key, so a
+# lookup never mixes the index from before a merge with the one after.
+
+import binascii
+import errno
+import hashlib
+import mmap
+import os
+import struct
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from privkey_write import writeseqtlvasn1
+
+
+indexmagic = b'RCPKIDX1'
+indexheader = struct.Struct('>8sQ')     # magic, number of sorted entries
+indexentry = struct.Struct('>32sQI')    # fingerprint, frame offset, frame length
+
+# Maximum number of unsorted entries before they get merged
+tailmax = 256
+
+
+def fingerprint(mod, exp):
+    """ Return the fingerprint of the public key mod, exp as 32 bytes """
+    return hashlib.sha256(bytes(writeseqtlvasn1([mod, exp]))).digest()
+
+
+def hexfingerprint(fp):
+    """ Return a fingerprint as a hex string """
+    return binascii.hexlify(fp).decode('ASCII')
+
+
+def parsefingerprint(text):
+    """ Parse a hex fingerprint, as printed by hexfingerprint """
+    try:
+        fp = binascii.unhexlify(text.strip())
+    except (binascii.Error, TypeError, ValueError):
+        fp = b''
+    if(len(fp) != 32):
+        raise ValueError("Invalid fingerprint {}".format(text))
+    return fp
+
+
+class Archive(object):
+    """ Escrow archive of split keys, indexed by fingerprint """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.indexname = filename+".idx"
+
+    def lock(self, f, shared=False):
+        """ Take an exclusive (or shared) lock on the open file f, where supported """
+        if(fcntl is not None):
+            fcntl.flock(f.fileno(), fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+
+    def opendata(self):
+        """ Open the data file for reading with a shared lock, returning None when there is none """
+        try:
+            data = open(self.filename, mode="rb")
+        except (IOError, OSError) as e:
+            if(e.errno == errno.ENOENT):
+                return None
+            raise
+        self.lock(data, shared=True)
+        return data
+
+    def append(self, fp, frame):
+        """ Append a frame for the key with fingerprint fp """
+        with open(self.filename, mode="ab") as data:
+            self.lock(data)
+            data.seek(0, os.SEEK_END)
+            offset = data.tell()
+            data.write(frame)
+            data.flush()
+            os.fsync(data.fileno())
+            with open(self.indexname, mode="ab") as index:
+                if(index.tell() == 0):
+                    index.write(indexheader.pack(indexmagic, 0))
+                index.write(indexentry.pack(fp, offset, len(frame)))
+            (nsorted, nentries) = self.counts()
+            if(nentries-nsorted > tailmax):
+                self.merge()
+
+    def counts(self):
+        """ Return the number of sorted and of all entries in the index """
+        try:
+            index = open(self.indexname, mode="rb")
+        except (IOError, OSError):
+            return (0, 0)
+        with index:
+            return self.indexcounts(index)
+
+    def indexcounts(self, index):
+        """ Return the number of sorted and of all entries in the open index file """
+        size = os.fstat(index.fileno()).st_size
+        index.seek(0)
+        (magic, nsorted) = indexheader.unpack(index.read(indexheader.size))
+        if(magic != indexmagic):
+            raise ValueError("{} is not an archive index".format(self.indexname))
+        return (nsorted, (size-indexheader.size) // indexentry.size)
+
+    def merge(self):
+        """ Merge the unsorted tail into the sorted entries; the caller holds the lock """
+        with open(self.indexname, mode="rb") as index:
+            index.seek(indexheader.size)
+            raw = index.read()
+        n = len(raw) // indexentry.size
+        entries = [raw[i*indexentry.size:(i+1)*indexentry.size] for i in range(n)]
+        # Stable sort on the fingerprint: later entries for a key stay last
+        entries.sort(key=lambda e: e[:32])
+        tmpname = self.indexname+".tmp"
+        with open(tmpname, mode="wb") as index:
+            index.write(indexheader.pack(indexmagic, n))
+            index.write(b''.join(entries))
+            index.flush()
+            os.fsync(index.fileno())
+        os.rename(tmpname, self.indexname)
+
+    def find(self, fp):
+        """ Find the most recent entry for fingerprint fp, returning (offset, length) or None """
+        data = self.opendata()
+        if(data is None):
+            return None
+        with data:
+            return self.lookup(fp)
+
+    def lookup(self, fp):
+        """ Find the most recent entry for fingerprint fp, returning (offset, length) or None; the caller holds the lock """
+        try:
+            index = open(self.indexname, mode="rb")
+        except (IOError, OSError):
+            return None
+        with index:
+            # Counts and entries both come from this one open index file
+            (nsorted, nentries) = self.indexcounts(index)
+            if(nentries == 0):
+                return None
+            m = mmap.mmap(index.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                def entry(i):
+                    o = indexheader.size + i*indexentry.size
+                    return indexentry.unpack(m[o:o+indexentry.size])
+                # The tail is most recent, search it backwards first
+                for i in range(nentries-1, nsorted-1, -1):
+                    (efp, offset, length) = entry(i)
+                    if(efp == fp):
+                        return (offset, length)
+                # Bisect for the last sorted entry with fingerprint <= fp
+                lo, hi = 0, nsorted
+                while(lo < hi):
+                    mid = (lo+hi) // 2
+                    if(fp < entry(mid)[0]):
+                        hi = mid
+                    else:
+                        lo = mid+1
+                if(lo > 0):
+                    (efp, offset, length) = entry(lo-1)
+                    if(efp == fp):
+                        return (offset, length)
+                return None
+            finally:
+                m.close()
+
+    def read(self, fp):
+        """ Return the frame of the key with fingerprint fp """
+        found = None
+        data = self.opendata()
+        if(data is not None):
+            with data:
+                found = self.lookup(fp)
+                if(found is not None):
+                    (offset, length) = found
+                    data.seek(offset)
+                    frame = data.read(length)
+        if(found is None):
+            raise LookupError("Key {} not in archive {}".format(hexfingerprint(fp), self.filename))
+        if(len(frame) != length):
+            raise ValueError("Truncated frame for key {} in archive {}".format(hexfingerprint(fp), self.filename))
+        return frame
@@ -0,0 +1,380 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# (C) Nikhef 2019 Mischa Salle
+
+# Append-only audit log for the RCauth private key exchange. It
+# - records split and reconstruct events (key fingerprint, pad ranges,
+#   time) as the leaves of a Merkle tree, as in RFC 6962 (see also
+#   blocktree/timber.c) but with SHA-256,
+# - returns the tree head, inclusion proofs of entries and consistency
+#   proofs between two tree sizes, and verifies them.
+#
+# The log <log> holds the entries, one JSON object per line.  <log>.idx
+# holds the offset and length of each entry, <log>.tree the hashes of all
+# complete subtrees, in the order in which they are completed: each leaf
+# is followed by the subtrees it completes (the layout of a Merkle
+# mountain range).  The position of a subtree follows from its level and
+# index, so nothing is ever rebuilt: an append writes the leaf and merges
+# it with the frontier (the roots of the complete subtrees at the end of
+# the tree, O(log n) of them), and a tree head or proof reads only the
+# O(log n) subtree hashes it needs.
+#
+# Appends hold an exclusive flock on the log, so concurrent batch workers
+# can share it.  An append writes the entry, then its index record, then
+# the tree; the number of leaves in the tree is the size of the log, so a
+# crash leaves at most an unreferenced entry or index record behind,
+# which the next append skips or overwrites.
+#
+# Usage: privkey_audit.py <log> head [<size>]
+#        privkey_audit.py <log> inclusion <index> [<size>]
+#        privkey_audit.py <log> consistency <size1> [<size2>]
+
+import binascii
+import hashlib
+import os
+import struct
+import sys
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+treemagic = b'RCPKMTH1'
+idxmagic = b'RCPKMTI1'
+idxentry = struct.Struct('>QI')         # entry offset, entry length
+HASHSIZE = 32
+
+
+def leafhash(entry):
+    """ RFC 6962 hash of a leaf """
+    return hashlib.sha256(b'\x00' + bytes(entry)).digest()
+
+
+def nodehash(left, right):
+    """ RFC 6962 hash of an interior node """
+    return hashlib.sha256(b'\x01' + left + right).digest()
+
+
+def emptyhash():
+    """ RFC 6962 hash of the empty tree """
+    return hashlib.sha256(b'').digest()
+
+
+def popcount(n):
+    """ Number of bits set in n """
+    return bin(n).count('1')
+
+
+def splitsize(n):
+    """ Largest power of two smaller than n > 1 """
+    k = 1
+    while(k << 1 < n):
+        k <<= 1
+    return k
+
+
+def nodecount(n):
+    """ Number of complete subtrees in a tree of n leaves """
+    return 2*n - popcount(n)
+
+
+def nodepos(level, index):
+    """ Position in the tree file of the complete subtree of 2**level leaves starting at leaf index*2**level """
+    last = ((index+1) << level) - 1
+    return nodecount(last) + level
+
+
+def treesize(nodes):
+    """ Number of leaves of the largest complete tree with at most nodes subtrees """
+    n = nodes // 2
+    while(nodecount(n+1) <= nodes):
+        n += 1
+    return n
+
+
+def event(op, mod, exp, pads, length, when=None):
+    """ Return the log entry of a split or join of the key mod, exp with length bytes of each (pad, offset) """
+    """ A pad is a PadSource or the name of the random file; pads read from stdin show as - """
+    import json
+    from privkey_archive import fingerprint, hexfingerprint
+    if(when is None):
+        when = time.time()
+    ranges = []
+    for (pad, offset) in pads:
+        if(not isinstance(pad, str)):
+            pad = getattr(pad, 'filename', '-')
+        ranges.append([pad, offset, length])
+    entry = {"op": op,
+             "time": time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(when)),
+             "fingerprint": hexfingerprint(fingerprint(mod, exp)),
+             "pads": ranges}
+    return json.dumps(entry, sort_keys=True, separators=(',', ':')).encode('utf-8')
+
+
+class AuditLog(object):
+    """ Append-only Merkle tree log of escrow events """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.idxname = filename+".idx"
+        self.treename = filename+".tree"
+
+    def lock(self, f):
+        """ Take an exclusive lock on the open file f, where supported """
+        if(fcntl is not None):
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+
+    def size(self):
+        """ Number of entries in the log """
+        try:
+            nodes = (os.path.getsize(self.treename)-len(treemagic)) // HASHSIZE
+        except OSError:
+            return 0
+        return treesize(max(nodes, 0))
+
+    def append(self, entry):
+        """ Append an entry (bytes, no newlines), returning its index """
+        if(b'\n' in entry):
+            raise ValueError("Log entries cannot contain newlines")
+        with open(self.filename, mode="ab") as data:
+            self.lock(data)
+            n = self.size()
+            # Entry, index record, tree: each refers to the ones before
+            data.seek(0, os.SEEK_END)
+            offset = data.tell()
+            data.write(entry + b'\n')
+            data.flush()
+            os.fsync(data.fileno())
+            self.writeat(self.idxname, idxmagic, len(idxmagic) + n*idxentry.size,
+                         idxentry.pack(offset, len(entry)))
+            # Merge the leaf with the frontier, one level per trailing one
+            # bit of n: the subtrees it completes
+            h = leafhash(entry)
+            hashes = [h]
+            if(n & 1):
+                with open(self.treename, mode="rb") as tree:
+                    level = 0
+                    while((n >> level) & 1):
+                        h = nodehash(self.readnode(tree, level, (n >> level)-1), h)
+                        hashes.append(h)
+                        level += 1
+            self.writeat(self.treename, treemagic, len(treemagic) + nodecount(n)*HASHSIZE,
+                         b''.join(hashes))
+        return n
+
+    def writeat(self, filename, magic, offs, octets):
+        """ Write octets at offs of the file, creating it with magic, dropping anything after them """
+        fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o644)
+        with os.fdopen(fd, "r+b") as f:
+            if(offs == len(magic)):
+                f.write(magic)
+            else:
+                if(f.read(len(magic)) != magic):
+                    raise ValueError("{} is not part of an audit log".format(filename))
+                f.seek(offs)
+            f.write(octets)
+            f.truncate()
+            f.flush()
+            os.fsync(f.fileno())
+
+    def readnode(self, tree, level, index):
+        """ Read the hash of a complete subtree from the open tree file """
+        tree.seek(len(treemagic) + nodepos(level, index)*HASHSIZE)
+        h = tree.read(HASHSIZE)
+        if(len(h) != HASHSIZE):
+            raise ValueError("{} is truncated".format(self.treename))
+        return h
+
+    def subtree(self, tree, start, size):
+        """ Hash of the leaves start to start+size, of which all complete subtrees are in the open tree file """
+        if(size & (size-1) == 0 and start % size == 0):
+            return self.readnode(tree, size.bit_length()-1, start // size)
+        k = splitsize(size)
+        return nodehash(self.subtree(tree, start, k), self.subtree(tree, start+k, size-k))
+
+    def checksize(self, n):
+        """ Return n, by default the current size, checking it against the current size """
+        size = self.size()
+        if(n is None):
+            return size
+        if(n < 0 or n > size):
+            raise ValueError("Log has {} entries, not {}".format(size, n))
+        return n
+
+    def entry(self, i):
+        """ Return entry i """
+        if(i < 0 or i >= self.size()):
+            raise IndexError("No entry {} in the log".format(i))
+        with open(self.idxname, mode="rb") as idx:
+            idx.seek(len(idxmagic) + i*idxentry.size)
+            (offset, length) = idxentry.unpack(idx.read(idxentry.size))
+        with open(self.filename, mode="rb") as data:
+            data.seek(offset)
+            return data.read(length)
+
+    def head(self, n=None):
+        """ Return the size and root hash of the tree of the first n entries, by default all """
+        n = self.checksize(n)
+        if(n == 0):
+            return (0, emptyhash())
+        with open(self.treename, mode="rb") as tree:
+            return (n, self.subtree(tree, 0, n))
+
+    def inclusion(self, i, n=None):
+        """ Return the leaf hash of entry i and its inclusion proof in the tree of the first n entries """
+        n = self.checksize(n)
+        if(i < 0 or i >= n):
+            raise IndexError("No entry {} in a log of {} entries".format(i, n))
+        # PATH(i, D[start:start+size]) of RFC 6962, from the root down
+        subtrees = []
+        start, size = 0, n
+        while(size > 1):
+            k = splitsize(size)
+            if(i-start < k):
+                subtrees.append((start+k, size-k))
+                size = k
+            else:
+                subtrees.append((start, k))
+                start, size = start+k, size-k
+        with open(self.treename, mode="rb") as tree:
+            leaf = self.readnode(tree, 0, i)
+            return (leaf, [self.subtree(tree, s, z) for (s, z) in reversed(subtrees)])
+
+    def consistency(self, m, n=None):
+        """ Return the consistency proof of the tree of the first m entries with that of the first n """
+        n = self.checksize(n)
+        if(m < 0 or m > n):
+            raise ValueError("Cannot prove {} entries consistent with {}".format(m, n))
+        if(m == 0 or m == n):
+            return []
+        # SUBPROOF(m, D[start:start+size], b) of RFC 6962, from the root down
+        subtrees = []
+        start, size, whole = 0, n, True
+        while(m-start != size):
+            k = splitsize(size)
+            if(m-start <= k):
+                subtrees.append((start+k, size-k))
+                size = k
+            else:
+                subtrees.append((start, k))
+                start, size, whole = start+k, size-k, False
+        if(not whole):
+            subtrees.append((start, size))
+        with open(self.treename, mode="rb") as tree:
+            return [self.subtree(tree, s, z) for (s, z) in reversed(subtrees)]
+
+
+def verifyinclusion(leaf, i, n, proof, root):
+    """ Verify the inclusion proof of the leaf hash of entry i in the tree of n entries with the given root (RFC 9162) """
+    if(i < 0 or i >= n):
+        return False
+    fn, sn = i, n-1
+    r = leaf
+    for p in proof:
+        if(sn == 0):
+            return False
+        if(fn & 1 or fn == sn):
+            r = nodehash(p, r)
+            while(not fn & 1 and fn != 0):
+                fn >>= 1
+                sn >>= 1
+        else:
+            r = nodehash(r, p)
+        fn >>= 1
+        sn >>= 1
+    return sn == 0 and r == root
+
+
+def verifyconsistency(m, n, root1, root2, proof):
+    """ Verify the consistency proof of the tree of m entries with root1 and that of n entries with root2 (RFC 9162) """
+    if(m < 0 or m > n):
+        return False
+    if(m == n):
+        return not proof and root1 == root2
+    if(m == 0):
+        return not proof
+    if(not proof):
+        return False
+    if(m & (m-1) == 0):
+        proof = [root1] + list(proof)
+    fn, sn = m-1, n-1
+    while(fn & 1):
+        fn >>= 1
+        sn >>= 1
+    fr = sr = proof[0]
+    for c in proof[1:]:
+        if(sn == 0):
+            return False
+        if(fn & 1 or fn == sn):
+            fr = nodehash(c, fr)
+            sr = nodehash(c, sr)
+            while(not fn & 1 and fn != 0):
+                fn >>= 1
+                sn >>= 1
+        else:
+            sr = nodehash(sr, c)
+        fn >>= 1
+        sn >>= 1
+    return sn == 0 and fr == root1 and sr == root2
+
+
+def record(filename, op, mod, exp, pads, length):
+    """ Record a split or join in the audit log in filename, returning the index of its entry """
+    return AuditLog(filename).append(event(op, mod, exp, pads, length))
+
+
+def hexhash(h):
+    """ Return a hash as a hex string """
+    return binascii.hexlify(h).decode('ASCII')
+
+
+def main():
+    usage = ("Usage: privkey_audit.py <log> head [<size>]\n"
+             "       privkey_audit.py <log> inclusion <index> [<size>]\n"
+             "       privkey_audit.py <log> consistency <size1> [<size2>]\n")
+    args = sys.argv[1:]
+    if(len(args) < 2 or args[1] not in ("head", "inclusion", "consistency") or
+       len(args) > (3 if args[1] == "head" else 4) or (args[1] != "head" and len(args) < 3)):
+        sys.stderr.write(usage)
+        return 1
+    log = AuditLog(args[0])
+    try:
+        numbers = [int(a) for a in args[2:]]
+        if(args[1] == "head"):
+            (n, root) = log.head(*numbers)
+            print("size=%d\nroot=%s" % (n, hexhash(root)))
+        elif(args[1] == "inclusion"):
+            (n, root) = log.head(*numbers[1:])
+            (leaf, proof) = log.inclusion(numbers[0], n)
+            print("size=%d\nroot=%s\nentry=%s\nleaf=%s" % (n, hexhash(root), log.entry(numbers[0]).decode('utf-8'), hexhash(leaf)))
+            for h in proof:
+                print("proof=%s" % hexhash(h))
+        else:
+            (m, root1) = log.head(numbers[0])
+            (n, root2) = log.head(*numbers[1:])
+            print("size1=%d\nroot1=%s\nsize2=%d\nroot2=%s" % (m, hexhash(root1), n, hexhash(root2)))
+            for h in log.consistency(m, n):
+                print("proof=%s" % hexhash(h))
+    except (IOError, ValueError, IndexError) as e:
+        sys.stderr.write("ERROR: %s\n" % e)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# (C) Nikhef 2019 Mischa Salle
+
+# Batch mode for convert.py and convert_revert.py. It
+# - reads a manifest with one key per line,
+# - splits or joins the keys in a pool of worker processes,
+# - yields the results in the order of the manifest.
+#
+# Each manifest line has the form
+#   <key-source> <random-file> <offset> <random-file> <offset> [...]
+# Empty lines and lines starting with # are ignored. For convert.py the
+# key source is the private key file, for convert_revert.py it is a file
+# with the mod=, exp= and XOR= lines or the binary frame of one key, or
+# the fingerprint of the key when reading from an escrow archive.
+# With --ledger the offsets may be left out,
+#   <key-source> <random-file> [<offset>] <random-file> [<offset>] [...]
+# and are taken from the ledgers of the random files (convert.py) or from
+# the offsets recorded with the split key (convert_revert.py).
+
+import multiprocessing
+
+import privkey_audit
+import privkey_stats
+
+from privkey_split import PadSource, parserandoms, recordedoffsets, closepads, join_key, dumpsplit, loadsplitrecord, zero
+from privkey_openssl import checkoutput
+from privkey_ledger import openledgers, split_key_ledger
+
+
+class BatchRecord(object):
+    """ One line of a batch manifest """
+    def __init__(self, lineno, source, pads):
+        self.lineno = lineno
+        self.source = source
+        self.pads = pads        # list of (filename, offset)
+
+
+def readmanifest(filename, needoffsets=True):
+    """ Read a batch manifest, returning a list of BatchRecord """
+    """ Without needoffsets an offset may be left out after a random file, it is None then """
+    records = []
+    with open(filename) as f:
+        for lineno, line in enumerate(f, 1):
+            fields = line.split()
+            if(not fields or fields[0].startswith('#')):
+                continue
+            try:
+                pads = parserandoms(fields[1:], needoffsets)
+            except ValueError as e:
+                raise ValueError("{}:{}: {}".format(filename, lineno, e))
+            if(len(pads) < 2):
+                raise ValueError("{}:{}: expected <key-source> followed by at least two <random-file> <offset> pairs".format(filename, lineno))
+            records.append(BatchRecord(lineno, fields[0], pads))
+    return records
+
+
+def openpads(record):
+    """ Open the pads of a record, returning a list of (PadSource, offset) """
+    pads = []
+    try:
+        for (name, offset) in record.pads:
+            pad = PadSource(name)
+            for (other, o) in pads:
+                if(pad.sameas(other)):
+                    pad.close()
+                    raise ValueError("random data {} is used twice".format(name))
+            pads.append((pad, offset))
+    except:
+        closepads(pads)
+        raise
+    return pads
+
+
+def splitrecord(args):
+    """ Worker: split the key of a record, returning (record, output, error) """
+    record, input_cmd, binary, ledger, ledgerdir, auditlog, passphrase = args
+    try:
+        if(input_cmd):
+            key = checkoutput(input_cmd+[record.source], passphrase)
+        else:
+            with open(record.source, mode="rb") as f:
+                key = f.read()
+        pads = openpads(record)
+        try:
+            if(ledger):
+                ledgers = openledgers(pads, ledgerdir)
+            else:
+                ledgers = [None]*len(pads)
+            # Ledgers are locked while updated, so workers can share pads
+            (mod, exp, xor, offsets, tag) = split_key_ledger(key, pads, ledgers)
+            if(auditlog is not None):
+                privkey_audit.record(auditlog, "split", mod, exp, zip([pad for (pad, o) in pads], offsets), len(xor))
+        finally:
+            closepads(pads)
+        output = dumpsplit(mod, exp, xor, binary, label=record.source, offsets=offsets if ledger else None, tag=tag)
+        zero(xor)
+        return (record, output, None)
+    except Exception as e:
+        return (record, None, str(e))
+
+
+def joinrecord(args):
+    """ Worker: join the XOR-ed key of a record, returning (record, der, error) """
+    record, archive, rounds, auditlog = args
+    try:
+        if(archive is not None):
+            from privkey_archive import parsefingerprint
+            (mod, exp, xor, offsets, tag) = loadsplitrecord(archive.read(parsefingerprint(record.source)))
+        else:
+            with open(record.source, mode="rb") as f:
+                (mod, exp, xor, offsets, tag) = loadsplitrecord(f.read())
+        try:
+            pads = openpads(BatchRecord(record.lineno, record.source, recordedoffsets(record.pads, offsets)))
+        except:
+            zero(xor)
+            raise
+        try:
+            der = join_key(mod, exp, xor, pads, tag, rounds)
+            if(auditlog is not None):
+                privkey_audit.record(auditlog, "join", mod, exp, pads, len(xor))
+        finally:
+            zero(xor)
+            closepads(pads)
+        return (record, der, None)
+    except Exception as e:
+        return (record, None, str(e))
+
+
+def runbatch(worker, items, processes=None):
+    """ Run worker over items in a pool sized to the number of cores, yielding results in input order """
+    """ With --stats, the workers collect statistics that are added to those of this process """
+    if(privkey_stats.enabled):
+        pool = multiprocessing.Pool(processes, privkey_stats.enable, (privkey_stats.tracing,))
+        items = [(worker, item) for item in items]
+        worker = privkey_stats.collect
+    else:
+        pool = multiprocessing.Pool(processes)
+    try:
+        for result in pool.imap(worker, items):
+            if(privkey_stats.enabled):
+                (result, stats) = result
+                privkey_stats.merge(stats)
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
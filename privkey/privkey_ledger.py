@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# (C) Nikhef 2019 Mischa Salle
+
+# One-time-pad allocation ledger for the RCauth private key exchange. It
+# - records which ranges of a pad file have been used,
+# - hands out the next free range of a pad automatically,
+# - refuses ranges given by hand that overlap used ones.
+#
+# The ledger of a pad file <pad> is <pad>.ledger, or, when a ledger
+# directory is given, <ledgerdir>/<name>-<hash>.ledger with the hash of
+# the real path of the pad, so pads of the same name in different
+# directories get their own ledgers.
+#
+# A ledger is a header of magic, the pad size and the number of sorted
+# ranges, followed by the used ranges as (start, end) pairs: first the
+# sorted and coalesced ones, then a short unsorted tail of ranges reserved
+# since.  Allocation starts at the end of the highest used range and
+# extends the last pair in place when that is the highest; so the ledger
+# does not grow with the number of exports, and an allocation reads and
+# writes a constant number of bytes.  Reserving a given range bisects the
+# sorted pairs, scans the tail and appends to it; when the tail grows
+# beyond tailmax ranges, the ledger is sorted and coalesced again.
+# All updates hold an exclusive flock on the ledger, so concurrent batch
+# workers can allocate from the same pad.  A range allocated for a key
+# that then fails stays used: random data is never handed out twice.
+
+import hashlib
+import os
+import struct
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from privkey_split import PadSource, keyprime, primetag, xorpads
+
+
+ledgermagic = b'RCPKLDG1'
+ledgerheader = struct.Struct('>8sQQ')   # magic, pad size, number of sorted ranges
+ledgerrange = struct.Struct('>QQ')      # start, end (exclusive)
+
+# Maximum number of unsorted ranges before they get sorted in
+tailmax = 64
+
+
+def ledgername(padname, ledgerdir):
+    """ Return the name of the ledger in ledgerdir of the pad file padname """
+    path = os.path.realpath(padname)
+    if(not isinstance(path, bytes)):
+        path = path.encode('utf-8')
+    return os.path.join(ledgerdir, "{}-{}.ledger".format(os.path.basename(padname), hashlib.sha256(path).hexdigest()[:16]))
+
+
+def coalesce(ranges):
+    """ Sort the non-overlapping ranges and join the adjacent ones """
+    merged = []
+    for (s, e) in sorted(ranges):
+        if(merged and merged[-1][1] == s):
+            merged[-1] = (merged[-1][0], e)
+        else:
+            merged.append((s, e))
+    return merged
+
+
+class Ledger(object):
+    """ Allocation ledger of the used ranges of a pad file """
+
+    def __init__(self, padname, padsize, ledgerdir=None):
+        if(ledgerdir):
+            self.filename = ledgername(padname, ledgerdir)
+        else:
+            self.filename = padname+".ledger"
+        self.padname = padname
+        self.padsize = padsize
+
+    def open(self):
+        """ Open and lock the ledger, creating it if needed, returning the file object and the number of sorted ranges """
+        f = open(self.filename, mode="a+b")
+        try:
+            if(fcntl is not None):
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            f.seek(0, os.SEEK_END)
+            if(f.tell() == 0):
+                f.write(ledgerheader.pack(ledgermagic, self.padsize, 0))
+                f.flush()
+            f.seek(0)
+            header = f.read(ledgerheader.size)
+            if(len(header) != ledgerheader.size or header[:8] != ledgermagic):
+                raise ValueError("{} is not a pad ledger".format(self.filename))
+            (magic, padsize, nsorted) = ledgerheader.unpack(header)
+            if(padsize != self.padsize):
+                raise ValueError("Ledger {} is for a pad of {} bytes, {} has {}".format(self.filename, padsize, self.padname, self.padsize))
+        except:
+            f.close()
+            raise
+        return (f, nsorted)
+
+    def count(self, f):
+        """ Number of ranges in the open ledger f """
+        f.seek(0, os.SEEK_END)
+        return (f.tell()-ledgerheader.size) // ledgerrange.size
+
+    def readrange(self, f, i):
+        """ Read range i of the open ledger f """
+        f.seek(ledgerheader.size + i*ledgerrange.size)
+        return ledgerrange.unpack(f.read(ledgerrange.size))
+
+    def readranges(self, f, start, stop):
+        """ Read ranges start up to stop of the open ledger f """
+        f.seek(ledgerheader.size + start*ledgerrange.size)
+        raw = f.read((stop-start)*ledgerrange.size)
+        return [ledgerrange.unpack_from(raw, i*ledgerrange.size) for i in range(stop-start)]
+
+    def writerange(self, i, r):
+        """ Overwrite range i of the ledger with r """
+        # In append mode writes go to the end, so reopen for the update
+        with open(self.filename, mode="r+b") as g:
+            g.seek(ledgerheader.size + i*ledgerrange.size)
+            g.write(ledgerrange.pack(*r))
+            g.flush()
+            os.fsync(g.fileno())
+
+    def appendrange(self, f, r):
+        """ Append range r to the tail of the open ledger f """
+        f.write(ledgerrange.pack(*r))
+        f.flush()
+        os.fsync(f.fileno())
+
+    def rewrite(self, ranges):
+        """ Replace all ranges of the ledger with the sorted and coalesced ranges """
+        with open(self.filename, mode="r+b") as g:
+            g.write(ledgerheader.pack(ledgermagic, self.padsize, len(ranges)))
+            g.write(b''.join(ledgerrange.pack(s, e) for (s, e) in ranges))
+            g.truncate()
+            g.flush()
+            os.fsync(g.fileno())
+
+    def allocate(self, length):
+        """ Allocate the next free range of length bytes, returning its offset """
+        (f, nsorted) = self.open()
+        try:
+            n = self.count(f)
+            # The last sorted range is the highest of them, the tail is short
+            last = self.readranges(f, max(nsorted-1, 0), n)
+            offset = max([e for (s, e) in last] or [0])
+            if(offset+length > self.padsize):
+                raise ValueError("Random data {} exhausted: {} bytes needed at offset {}, {} available".format(self.padname, length, offset, self.padsize-offset))
+            if(last and last[-1][1] == offset):
+                self.writerange(n-1, (last[-1][0], offset+length))
+            else:
+                self.appendrange(f, (offset, offset+length))
+                if(n+1-nsorted > tailmax):
+                    self.rewrite(coalesce(self.readranges(f, 0, n+1)))
+            return offset
+        finally:
+            f.close()
+
+    def reserve(self, offset, length):
+        """ Record the range of length bytes at offset as used, refusing it if it overlaps a used range """
+        end = offset+length
+        if(offset < 0 or end > self.padsize):
+            raise ValueError("Random data {} of {} bytes too short for {} bytes at offset {}".format(self.padname, self.padsize, length, offset))
+        (f, nsorted) = self.open()
+        try:
+            n = self.count(f)
+            # Bisect for the first sorted range ending after offset
+            lo, hi = 0, nsorted
+            while(lo < hi):
+                mid = (lo+hi) // 2
+                if(self.readrange(f, mid)[1] <= offset):
+                    lo = mid+1
+                else:
+                    hi = mid
+            used = self.readranges(f, nsorted, n)
+            if(lo < nsorted):
+                used.append(self.readrange(f, lo))
+            for (s, e) in used:
+                if(s < end and offset < e):
+                    raise ValueError("Random data {} bytes {} to {} were already used".format(self.padname, max(s, offset), min(e, end)))
+            self.appendrange(f, (offset, end))
+            if(n+1-nsorted > tailmax):
+                self.rewrite(coalesce(self.readranges(f, 0, n+1)))
+        finally:
+            f.close()
+
+    def ranges(self):
+        """ Return the used ranges as a sorted and coalesced list of (start, end) """
+        (f, nsorted) = self.open()
+        try:
+            return coalesce(self.readranges(f, 0, self.count(f)))
+        finally:
+            f.close()
+
+
+def openledgers(pads, ledgerdir=None):
+    """ Return the Ledger for each of the (pad, offset) pads, or None for pads not in a file """
+    return [Ledger(pad.filename, len(pad), ledgerdir) if isinstance(pad, PadSource) else None
+            for (pad, offset) in pads]
+
+
+def split_key_ledger(pem_bytes, pads, ledgers):
+    """ Split an unencrypted private key like split_key, taking the offset of each pad from its ledger """
+    """ pads is a list of (pad, offset) and ledgers a matching list of Ledger or None; when offset is None it is allocated from the ledger, otherwise the range is reserved in it """
+    """ Returns mod, exp, the XOR-ed p1 as a bytearray, the list of offsets used and the integrity tag of p1 """
+    (mod, exp, p1_bin) = keyprime(pem_bytes)
+    with p1_bin:
+        used = []
+        for ((pad, offset), ledger) in zip(pads, ledgers):
+            if(ledger is not None):
+                if(offset is None):
+                    offset = ledger.allocate(len(p1_bin))
+                else:
+                    ledger.reserve(offset, len(p1_bin))
+            used.append((pad, offset))
+        return (mod, exp, xorpads(p1_bin.buf, used), [offset for (pad, offset) in used], primetag(mod, exp, p1_bin.buf))
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# (C) Nikhef 2019 Mischa Salle
+
+# openssl helpers for the RCauth private key exchange, used by convert.py,
+# convert_revert.py and privkey_batch.py. It
+# - asks for the pass phrase of the keys once, keeping it in a bytearray
+#   that can be zeroed,
+# - hands the pass phrase to openssl through a pipe with -passin fd:<n> or
+#   -passout fd:<n>, so it never shows up on a command line,
+# - runs an openssl command and returns its output.
+#
+# The pool running many openssl processes at a time is in
+# privkey_opensslpool.py (Python 3.5 or later).
+
+import os
+
+
+def readpassphrase(confirm=False):
+    """ Prompt once for the pass phrase of the keys, returning it as a bytearray """
+    """ The str returned by getpass cannot be zeroed, it is not copied any further """
+    import getpass
+    passphrase = getpass.getpass("Enter pass phrase: ")
+    if(confirm and getpass.getpass("Verifying - Enter pass phrase: ") != passphrase):
+        raise ValueError("Pass phrases do not match")
+    if(isinstance(passphrase, bytes)):
+        return bytearray(passphrase)
+    return bytearray(passphrase, 'utf-8')
+
+
+def writeall(fd, data):
+    """ Write all of data to fd without copying it """
+    view = memoryview(data)
+    while len(view):
+        view = view[os.write(fd, view):]
+
+
+def passphrasepipe(passphrase):
+    """ Return the read end of a pipe holding the pass phrase, for openssl -passin or -passout fd:<n> """
+    """ A pass phrase fits in the pipe buffer, so it is written before the reader starts """
+    (r, w) = os.pipe()
+    try:
+        # Two writes, passphrase + b'\n' would be a copy that cannot be zeroed
+        writeall(w, passphrase)
+        writeall(w, b'\n')
+    finally:
+        os.close(w)
+    return r
+
+
+def passfds(fd):
+    """ Popen keyword arguments passing fd to the child process """
+    if(hasattr(os, 'set_inheritable')):
+        return {'pass_fds': (fd,)}
+    # Python 2: descriptors are inherited unless closed
+    return {'close_fds': False}
+
+
+def checkoutput(cmd, passphrase=None):
+    """ Run cmd and return its output like subprocess.check_output, handing it the pass phrase with -passin fd:<n> when given """
+    import subprocess
+    if(passphrase is None):
+        return subprocess.check_output(cmd)
+    fd = passphrasepipe(passphrase)
+    try:
+        return subprocess.check_output(cmd+['-passin', 'fd:%d' % fd], **passfds(fd))
+    finally:
+        os.close(fd)
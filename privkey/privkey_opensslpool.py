@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# (C) Nikhef 2019 Mischa Salle
+
+# Pool of openssl processes for the RCauth private key exchange, used by
+# convert_revert.py --batch to encrypt the reconstructed keys. It
+# - runs up to a given number of openssl processes concurrently with
+#   asyncio, each reading one key on stdin and writing it on stdout,
+# - hands every process the pass phrase through a pipe with
+#   -passout fd:<n> (or -passin fd:<n>), see privkey_openssl.py, so it is
+#   asked for only once,
+# - takes the keys from an iterator in a separate thread, so that reading
+#   and reconstructing the next key overlaps with the running processes,
+# - hands back the results in the order of the keys.
+#
+# Requires Python 3.5 or later.
+
+import asyncio
+import collections
+import os
+import time
+from asyncio.subprocess import PIPE
+
+import privkey_stats
+from privkey_openssl import passphrasepipe
+from privkey_split import zero
+
+
+async def runone(cmd, data, passphrase=None, option='-passout'):
+    """ Run cmd on data, returning a tuple (output, error) with error None on success """
+    """ data is zeroed once written to the process """
+    args = cmd
+    fds = ()
+    t = time.time()
+    if passphrase is not None:
+        fd = passphrasepipe(passphrase)
+        args = cmd+[option, 'fd:%d' % fd]
+        fds = (fd,)
+    try:
+        proc = await asyncio.create_subprocess_exec(*args, stdin=PIPE, stdout=PIPE, pass_fds=fds)
+        (out, err) = await proc.communicate(data)
+    except OSError as e:
+        return (None, str(e))
+    finally:
+        for fd in fds:
+            os.close(fd)
+        zero(data)
+        if(privkey_stats.enabled):
+            privkey_stats.add('subprocess', time.time()-t)
+    if proc.returncode != 0:
+        return (None, "%s failed, exitval %s" % (cmd[0], proc.returncode))
+    return (out, None)
+
+
+async def pipeline(jobs, cmd, emit, passphrase, option, limit):
+    """ Run cmd on the data of every job with at most limit processes, calling emit in order """
+    loop = asyncio.get_event_loop()
+    slots = asyncio.Semaphore(limit)
+    # Results waiting for an earlier key are kept, up to 2*limit keys
+    pending = collections.deque()
+    end = object()
+    jobs = iter(jobs)
+
+    async def start(data):
+        try:
+            return await runone(cmd, data, passphrase, option)
+        finally:
+            slots.release()
+
+    def ready():
+        return pending and (pending[0][1] is None or pending[0][1].done())
+
+    async def emitfirst():
+        (tag, task, error) = pending.popleft()
+        out = None
+        if task is not None:
+            (out, error) = await task
+        emit(tag, out, error)
+
+    try:
+        while True:
+            job = await loop.run_in_executor(None, next, jobs, end)
+            if job is end:
+                break
+            (tag, data, error) = job
+            task = None
+            if error is None:
+                await slots.acquire()
+                task = loop.create_task(start(data))
+            pending.append((tag, task, error))
+            while ready() or len(pending) >= 2*limit:
+                await emitfirst()
+        while pending:
+            await emitfirst()
+    finally:
+        # Do not leave processes behind when emit or the jobs fail
+        tasks = [task for (tag, task, error) in pending if task is not None]
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def runpipeline(jobs, cmd, emit, passphrase=None, option='-passout', limit=None):
+    """ Run cmd on every job from jobs, a tuple (tag, data, error), calling emit(tag, output, error) in order """
+    """ Jobs with an error are passed on to emit without running cmd, limit defaults to the number of CPUs """
+    if limit is None:
+        limit = os.cpu_count() or 1
+    loop = asyncio.new_event_loop()
+    # The child watcher of Python < 3.8 only works for the current loop
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(pipeline(jobs, cmd, emit, passphrase, option, max(1, limit)))
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# (C) Nikhef 2019 Mischa Salle
+
+# Offset recovery for convert_revert.py. It
+# - scans the offsets within a window around the given offsets of one or
+#   more pads, keeping the offsets of the other pads fixed,
+# - XORs the XOR-ed p1 with each candidate and tests whether the result is
+#   a prime factor of the modulus,
+# - spreads the candidates over a pool of worker processes.
+#
+# Consecutive candidate windows of a pad overlap in all but one byte, so a
+# candidate is never rebuilt from bytes: the window is kept as a big
+# integer and slid along the pad by one byte with a shift, a mask and an
+# OR.  The XOR-ed p1 and the fixed pads are folded into a single integer
+# beforehand, so each candidate costs a slide, a XOR and, when odd, a
+# modulo.  Searching several pads at once scans all combinations of their
+# offsets, which grows with the product of the window sizes.
+
+import multiprocessing
+
+from privkey_split import PadSource, padwindow, bytes2int, xorpads, zero
+from privkey_batch import runbatch
+
+
+# Number of chunks per worker the candidates of the first searched pad are
+# split in, so that a hit early in the window stops the search early
+CHUNKSPERWORKER = 4
+
+
+def padrange(pad, offset, window, length):
+    """ Return the first and last+1 candidate offset within window of offset for length bytes of pad """
+    return (max(offset-window, 0), max(min(offset+window, len(pad)-length)+1, 0))
+
+
+def openpad(source):
+    """ Return the pad for a source, either a file name or the random data itself """
+    if(isinstance(source, bytearray)):
+        return source
+    return PadSource(source)
+
+
+def scanregions(mod, fixed, length, regions, offsets, found):
+    """ Scan the candidates of the first region, recursing into the others, appending hits to found """
+    (start, region) = regions[0]
+    mask = (1 << 8*length)-1
+    v = bytes2int(region[0:length])
+    for i in range(len(region)-length+1):
+        if(i > 0):
+            v = ((v << 8) & mask) | region[i+length-1]
+        p = fixed ^ v
+        if(len(regions) > 1):
+            scanregions(mod, p, length, regions[1:], offsets+[start+i], found)
+        elif(p & 1 and p > 1 and mod % p == 0):
+            found.append(offsets+[start+i])
+    return found
+
+
+def searchchunk(args):
+    """ Worker: scan the candidate offsets of the searched pads, returning the combinations for which p1 divides mod """
+    (mod, fixed, length, sources, ranges) = args
+    regions = []
+    try:
+        for (source, (start, stop)) in zip(sources, ranges):
+            pad = openpad(source)
+            try:
+                # All candidate windows of this pad in one read
+                regions.append((start, bytearray(padwindow(pad, start, stop-start-1+length))))
+            finally:
+                if(isinstance(pad, PadSource)):
+                    pad.close()
+        return scanregions(mod, fixed, length, regions, [], [])
+    finally:
+        for (start, region) in regions:
+            zero(region)
+
+
+def searchoffsets(mod, xor, pads, searched, window, processes=None):
+    """ Search the offsets within window of the given ones for the pads with an index in searched """
+    """ pads is a list of (pad, offset), the pads not searched keep their offset """
+    """ Returns the first list of offsets of all pads for which the XOR-ed p1 is a factor of mod, or None """
+    length = len(xor)
+    p = xorpads(xor, [pads[i] for i in range(len(pads)) if i not in searched])
+    fixed = bytes2int(p)
+    zero(p)
+    sources = []
+    ranges = []
+    for i in searched:
+        (pad, offset) = pads[i]
+        sources.append(pad.filename if isinstance(pad, PadSource) else pad)
+        ranges.append(padrange(pad, offset, window, length))
+    if(any(start >= stop for (start, stop) in ranges)):
+        return None
+    # Split the candidates of the first searched pad over the workers
+    (start, stop) = ranges[0]
+    nchunks = (processes or multiprocessing.cpu_count())*CHUNKSPERWORKER
+    chunk = max((stop-start+nchunks-1) // nchunks, 1)
+    items = [(mod, fixed, length, sources, [(s, min(s+chunk, stop))]+ranges[1:])
+             for s in range(start, stop, chunk)]
+    results = runbatch(searchchunk, items, processes)
+    try:
+        for found in results:
+            if(found):
+                offsets = [offset for (pad, offset) in pads]
+                for (i, offset) in zip(searched, found[0]):
+                    offsets[i] = offset
+                return offsets
+    finally:
+        results.close()
+    return None
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# (C) Nikhef 2019 Mischa Salle
+
+# Buffers for key material in the RCauth private key exchange. It
+# - provides SecretBuffer, a fixed size buffer that is zeroed when done
+#   with, backed by a bytearray or an anonymous mmap, optionally locked
+#   into memory so it is never swapped out,
+# - zeroes any writable buffer with a single memset.
+#
+# Python integers and bytes objects are immutable and cannot be zeroed;
+# key material should only pass through them briefly, and be kept in
+# SecretBuffers (or bytearrays) otherwise.  ctypes is used where it is
+# available; without it, buffers are zeroed by slice assignment and
+# cannot be locked.
+
+import mmap
+
+try:
+    import ctypes
+except ImportError:
+    ctypes = None
+
+
+# Chunk size for zeroing without ctypes, so that zeroing a large buffer
+# needs only a small buffer of zeros
+ZEROCHUNK = 65536
+
+# The C library, for mlock and munlock; looked up by getlibc() when first
+# locking a buffer, as finding it is slow (and not needed for zeroing)
+libc = None
+
+
+def getlibc():
+    """ Return the C library, or None when it cannot be loaded """
+    global libc
+    if(libc is None and ctypes is not None):
+        try:
+            # Not import ctypes.util, which would make ctypes local here
+            from ctypes.util import find_library
+            lib = ctypes.CDLL(find_library("c"), use_errno=True)
+            lib.mlock.argtypes = lib.munlock.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+            libc = lib
+        except (OSError, AttributeError, TypeError):
+            pass
+    return libc
+
+
+def address(buf):
+    """ Return a ctypes array over the writable buffer buf, keeping it from being resized while it exists """
+    return (ctypes.c_char * len(buf)).from_buffer(buf)
+
+
+def wipe(buf):
+    """ Overwrite a writable buffer (bytearray or mmap) with zeros """
+    length = len(buf)
+    if(length == 0):
+        return
+    if(ctypes is not None):
+        carray = address(buf)
+        ctypes.memset(ctypes.addressof(carray), 0, length)
+        del carray
+        return
+    zeros = bytearray(min(length, ZEROCHUNK))
+    for i in range(0, length, ZEROCHUNK):
+        n = min(ZEROCHUNK, length-i)
+        buf[i:i+n] = zeros[:n]
+
+
+class SecretBuffer(object):
+    """ Fixed size buffer for key material, zeroed on close and when used as a context manager """
+    __slots__ = ('buf', 'carray', 'locked')
+
+    def __init__(self, size, anonymous=False, lock=False):
+        """ A buffer of size bytes, in an anonymous mmap instead of a bytearray, optionally locked in memory """
+        if(anonymous or lock):
+            # Page aligned, and not part of the Python heap
+            self.buf = mmap.mmap(-1, max(size, 1))
+            if(size == 0):
+                self.buf.close()
+                self.buf = bytearray(0)
+        else:
+            self.buf = bytearray(size)
+        self.carray = None
+        self.locked = False
+        if(lock and size > 0):
+            if(getlibc() is None):
+                raise OSError("Cannot lock memory without ctypes")
+            self.carray = address(self.buf)
+            if(libc.mlock(ctypes.addressof(self.carray), size) != 0):
+                self.close()
+                raise OSError(ctypes.get_errno(), "mlock failed")
+            self.locked = True
+
+    def __len__(self):
+        return len(self.buf)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __del__(self):
+        # __init__ may have failed before the buffer was made
+        if(getattr(self, 'buf', None) is not None):
+            self.close()
+
+    def view(self):
+        """ Return a memoryview on the buffer """
+        return memoryview(self.buf)
+
+    def wipe(self):
+        """ Overwrite the buffer with zeros """
+        if(self.buf is not None):
+            wipe(self.buf)
+
+    def close(self):
+        """ Zero the buffer, unlock and release it """
+        if(self.buf is None):
+            return
+        self.wipe()
+        if(self.locked):
+            libc.munlock(ctypes.addressof(self.carray), len(self.buf))
+            self.locked = False
+        self.carray = None
+        if(isinstance(self.buf, mmap.mmap)):
+            self.buf.close()
+        self.buf = None
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# (C) Nikhef 2019 Mischa Salle
+
+# Threshold mode for the RCauth private key exchange. It
+# - splits p1 into n shares, any k of which reconstruct it (Shamir secret
+#   sharing over GF(2^8), byte by byte),
+# - joins k or more shares back into p1,
+# - reads and writes shares in the text or binary exchange format.
+#
+# Each byte of p1 is the constant term of its own random polynomial of
+# degree k-1, and share x holds the values of all these polynomials at x.
+# The arithmetic works on whole buffers at once: addition in GF(2^8) is
+# XOR, done on the buffers as big integers, and multiplying a buffer by a
+# constant is a translate() through the 256 byte multiplication table of
+# that constant, built from the log/exp tables.  So a share costs k-1
+# translates and XORs, whatever the size of the prime.
+#
+# A share is written like the XOR-ed key, with share=, threshold= and Y=
+# lines instead of XOR=:
+#   tag=<integrity tag of p1>
+#   mod=<modulus>
+#   exp=<public exponent>
+#   share=<x>
+#   threshold=<k>
+#   Y=<share>
+
+import binascii
+import os
+
+import privkey_write
+from privkey_split import bytes2int, int2bytes, primetag, keyprime
+
+
+# log/exp tables of GF(2^8) with the AES polynomial x^8+x^4+x^3+x+1 and
+# generator 3; gfexp is doubled so a sum of two logs needs no reduction
+gfexp = bytearray(512)
+gflog = bytearray(256)
+x = 1
+for i in range(255):
+    gfexp[i] = x
+    gflog[x] = i
+    x ^= (x << 1) ^ (0x11b if x & 0x80 else 0)
+for i in range(255, 512):
+    gfexp[i] = gfexp[i-255]
+del x, i
+
+# Multiplication tables, for translate(), built when first needed
+multables = {}
+
+
+def gfmul(a, b):
+    """ Product of a and b in GF(2^8) """
+    if(a == 0 or b == 0):
+        return 0
+    return gfexp[gflog[a]+gflog[b]]
+
+
+def gfdiv(a, b):
+    """ Quotient of a and b in GF(2^8) """
+    if(b == 0):
+        raise ZeroDivisionError("Division by zero in GF(2^8)")
+    if(a == 0):
+        return 0
+    return gfexp[gflog[a]+255-gflog[b]]
+
+
+def multable(a):
+    """ The translate() table multiplying each byte by a in GF(2^8) """
+    table = multables.get(a)
+    if(table is None):
+        table = bytes(bytearray(gfmul(a, b) for b in range(256)))
+        multables[a] = table
+    return table
+
+
+def scale(buf, a):
+    """ Multiply each byte of buf by a in GF(2^8), returning a new bytearray """
+    return bytearray(buf).translate(multable(a))
+
+
+def splitsecret(secret, k, n):
+    """ Split secret into n shares, any k of which reconstruct it; returns a list of (x, bytearray) for x = 1..n """
+    if(k < 2 or k > n or n > 255):
+        raise ValueError("Need 2 <= k <= n <= 255 for a {} of {} split".format(k, n))
+    length = len(secret)
+    coeffs = [bytes2int(os.urandom(length)) for j in range(k-1)]
+    s = bytes2int(secret)
+    shares = []
+    for x in range(1, n+1):
+        # Horner: ((c[k-1] x + c[k-2]) x + ... + c[1]) x + secret
+        y = coeffs[-1]
+        for c in reversed(coeffs[:-1]):
+            y = bytes2int(scale(int2bytes(y, length), x)) ^ c
+        y = bytes2int(scale(int2bytes(y, length), x)) ^ s
+        shares.append((x, int2bytes(y, length)))
+    return shares
+
+
+def joinsecret(shares):
+    """ Reconstruct the secret from a list of (x, share), returning a bytearray """
+    xs = [x for (x, y) in shares]
+    if(len(set(xs)) != len(xs) or 0 in xs):
+        raise ValueError("Shares must have distinct, non-zero indices")
+    length = len(shares[0][1])
+    s = 0
+    for (i, (x, y)) in enumerate(shares):
+        if(len(y) != length):
+            raise ValueError("Shares have different lengths")
+        # Lagrange coefficient at 0: the product of xj / (xj - x), and
+        # subtraction is XOR
+        coeff = 1
+        for (j, xj) in enumerate(xs):
+            if(j != i):
+                coeff = gfmul(coeff, gfdiv(xj, xj ^ x))
+        s ^= bytes2int(scale(y, coeff))
+    return int2bytes(s, length)
+
+
+def split_key_shares(pem_bytes, k, n):
+    """ Split an unencrypted (PEM or DER) RSA private key into n shares of p1, any k of which reconstruct it """
+    """ Returns mod, exp, the list of (x, share) and the integrity tag of p1 """
+    (mod, exp, p1_bin) = keyprime(pem_bytes)
+    with p1_bin:
+        return (mod, exp, splitsecret(p1_bin.buf, k, n), primetag(mod, exp, p1_bin.buf))
+
+
+def dumpshare(mod, exp, x, k, y, tag=None, binary=False):
+    """ Dump one share in the text or binary exchange format, returning a bytearray """
+    if(binary):
+        extra = [(privkey_write.framesharex, x), (privkey_write.framethreshold, k)]
+        if(tag is not None):
+            extra.append((privkey_write.frametag, tag))
+        return privkey_write.packparts(mod, exp, y, privkey_write.frameshared, extra)
+    text = ""
+    if(tag is not None):
+        text += "tag=%s\n" % binascii.hexlify(tag).decode('ASCII')
+    text += "mod=%x\nexp=%d\nshare=%d\nthreshold=%d\nY=%s\n" % (mod, exp, x, k, binascii.hexlify(y).decode('ASCII'))
+    return bytearray(text, 'utf-8')
+
+
+def loadshare(octets):
+    """ Load one share in either format, returning mod, exp, x, k, the share as a bytearray and the integrity tag or None """
+    if(octets.startswith(privkey_write.framemagic)):
+        (mod, exp, y, flags, fields, offs) = privkey_write.unpackparts(octets)
+        if(not flags & privkey_write.frameshared):
+            raise ValueError("The prime in the frame is not a share")
+        try:
+            x = privkey_write.getintframe(fields[privkey_write.framesharex])
+            k = privkey_write.getintframe(fields[privkey_write.framethreshold])
+        except KeyError:
+            raise ValueError("Missing share index or threshold in frame")
+        tag = None
+        if(privkey_write.frametag in fields):
+            tag = bytearray(fields[privkey_write.frametag])
+        return (mod, exp, x, k, bytearray(y), tag)
+    mod = exp = x = k = y = tag = None
+    for line in octets.decode('utf-8').split('\n'):
+        line = line.strip()
+        if line.startswith("mod="):
+            mod = int(line[4:], 16)
+        elif line.startswith("exp="):
+            exp = int(line[4:])
+        elif line.startswith("share="):
+            x = int(line[6:])
+        elif line.startswith("threshold="):
+            k = int(line[10:])
+        elif line.startswith("Y="):
+            y = bytearray.fromhex(line[2:])
+        elif line.startswith("tag="):
+            tag = bytearray(binascii.unhexlify(line[4:]))
+    if(mod is None or exp is None or x is None or k is None or y is None):
+        raise ValueError("Missing mod=, exp=, share=, threshold= or Y= in input")
+    return (mod, exp, x, k, y, tag)
+
+
+def joinshares(loaded):
+    """ Join shares as returned by loadshare, checking they belong together; returns mod, exp, p1 as a bytearray and the tag """
+    (mod, exp, x, k, y, tag) = loaded[0]
+    for (mod2, exp2, x2, k2, y2, tag2) in loaded[1:]:
+        if((mod2, exp2, k2) != (mod, exp, k)):
+            raise ValueError("Shares {} and {} are not of the same split key".format(x, x2))
+    if(len(loaded) < k):
+        raise ValueError("Need {} shares, got {}".format(k, len(loaded)))
+    return (mod, exp, joinsecret([(l[2], l[4]) for l in loaded]), tag)
@@ -0,0 +1,434 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# (C) Nikhef 2019 Mischa Salle
+
+# In-process library for the RCauth private key exchange, used by
+# convert.py and convert_revert.py instead of running privkey_read.py and
+# privkey_write.py as child processes. It
+# - splits a private key into mod, exp and the p1 XOR-ed with the pads,
+# - joins mod, exp and the XOR-ed p1 back into a DER encoded private key,
+# - reads and writes the mod=/exp=/XOR= exchange format, and its binary
+#   framed counterpart (see privkey_write.py).
+#
+# A pad is a tuple (data, offset) where data is either a PadSource or a
+# bytearray of random data and offset the position in data where the pad
+# starts.
+
+import binascii
+import hashlib
+import hmac
+import mmap
+import os
+import struct
+import sys
+import threading
+
+import privkey_read
+import privkey_write
+from privkey_secret import SecretBuffer, wipe
+
+
+# Number of bytes looked at to decide whether a pad file is hex encoded
+SNIFFSIZE = 64
+
+HEXDIGITS = bytearray(b'0123456789abcdefABCDEF')
+WHITESPACE = bytearray(b' \t\r\n')
+
+
+class PadSource(object):
+    """ Random data in a file, either hex encoded ascii or binary, of which only the needed windows are read """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.map = None
+        # Hex pads are read with seek and read on the shared file object,
+        # e.g. from the threads of privkeyd.py
+        self.lock = threading.Lock()
+        self.f = open(filename, mode="rb")
+        try:
+            self.f.seek(0, os.SEEK_END)
+            filesize = self.f.tell()
+            self.f.seek(0)
+            head = bytearray(self.f.read(SNIFFSIZE))
+            # Leading whitespace was stripped in the old format too
+            start = 0
+            while(start < len(head) and head[start] in WHITESPACE):
+                start += 1
+            body = head[start:]
+            self.hex = len(body) > 0 and all(c in HEXDIGITS for c in body)
+            if(self.hex):
+                # Hex digits run from start up to any trailing whitespace
+                self.f.seek(max(filesize-SNIFFSIZE, 0))
+                tail = bytearray(self.f.read(SNIFFSIZE))
+                end = filesize
+                while(end > start and tail and tail[-1] in WHITESPACE):
+                    tail.pop()
+                    end -= 1
+                self.start = start
+                self.size = (end-start) // 2
+            else:
+                self.start = 0
+                self.size = filesize
+                if(filesize > 0):
+                    self.map = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        except:
+            self.f.close()
+            raise
+
+    def __len__(self):
+        return self.size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """ Unmap and close the pad file """
+        if(self.map is not None):
+            self.map.close()
+            self.map = None
+        if(self.f is not None):
+            self.f.close()
+            self.f = None
+
+    def sameas(self, other):
+        """ Check whether other is a PadSource for the same file """
+        if(not isinstance(other, PadSource)):
+            return False
+        st1 = os.fstat(self.f.fileno())
+        st2 = os.fstat(other.f.fileno())
+        return (st1.st_dev, st1.st_ino) == (st2.st_dev, st2.st_ino)
+
+    def window(self, offset, length):
+        """ Return length bytes from offset, as a read-only view for binary pads, as a bytearray for hex pads """
+        if(offset < 0 or offset+length > self.size):
+            raise ValueError("Random data {} of {} bytes too short for {} bytes at offset {}".format(self.filename, self.size, length, offset))
+        if(self.hex):
+            with self.lock:
+                self.f.seek(self.start+2*offset)
+                digits = self.f.read(2*length)
+            try:
+                return bytearray.fromhex(digits.decode('ASCII'))
+            except (UnicodeDecodeError, ValueError):
+                raise ValueError("Random data {} is not hex encoded at offset {}".format(self.filename, offset))
+        if(length == 0):
+            return bytearray(0)
+        try:
+            return memoryview(self.map)[offset:offset+length]
+        except TypeError:
+            # Python 2 mmap does not support memoryview
+            return self.map[offset:offset+length]
+
+
+# Length of the integrity tag of the prime
+TAGSIZE = 8
+
+
+# Lock the buffers holding a prime into memory, see privkey_secret.py
+LOCKSECRETS = False
+
+
+# int.from_bytes and <int>.to_bytes appear only in Python 3.2
+if(hasattr(int, 'from_bytes')):
+    def int2bytes(i, length, out=None):
+        """ Convert a non-negative integer into a big endian bytearray of given length, or into the buffer out """
+        if(out is None):
+            return bytearray(i.to_bytes(length, 'big'))
+        out[0:length] = i.to_bytes(length, 'big')
+        return out
+
+    def bytes2int(octets):
+        """ Convert a big endian byte string into a non-negative integer """
+        return int.from_bytes(octets, 'big')
+
+    def window(pad, offset, length):
+        """ Return a view on length bytes of pad starting at offset """
+        return memoryview(pad)[offset:offset+length]
+else:
+    def int2bytes(i, length, out=None):
+        """ Convert a non-negative integer into a big endian bytearray of given length, or into the buffer out """
+        if(out is None):
+            return bytearray(binascii.unhexlify("%0*x" % (2*length, i)))
+        out[0:length] = binascii.unhexlify("%0*x" % (2*length, i))
+        return out
+
+    def bytes2int(octets):
+        """ Convert a big endian byte string into a non-negative integer """
+        if(len(octets) == 0):
+            return 0
+        return int(binascii.hexlify(octets), 16)
+
+    def window(pad, offset, length):
+        """ Return length bytes of pad starting at offset """
+        return bytes(pad[offset:offset+length])
+
+
+def padwindow(pad, offset, length):
+    """ Return length bytes of a pad starting at offset """
+    if(isinstance(pad, PadSource)):
+        return pad.window(offset, length)
+    if(offset < 0 or offset+length > len(pad)):
+        raise ValueError("Pad of {} bytes too short for {} bytes at offset {}".format(len(pad), length, offset))
+    return window(pad, offset, length)
+
+
+def xorpads(data, pads, out=None):
+    """ XOR data with any number of pads, returning a new bytearray or writing into the buffer out """
+    length = len(data)
+    windows = []
+    try:
+        for (pad, offset) in pads:
+            windows.append(padwindow(pad, offset, length))
+        for i in range(len(windows)):
+            for j in range(i):
+                if(windows[i] == windows[j]):
+                    raise ValueError("Random data for pads {} and {} is the same".format(j+1, i+1))
+        # XOR as big integers: one interpreted operation per pad instead of
+        # one per byte
+        v = bytes2int(data)
+        for w in windows:
+            v ^= bytes2int(w)
+        return int2bytes(v, length, out)
+    finally:
+        for w in windows:
+            if(isinstance(w, bytearray)):
+                zero(w)
+            elif(isinstance(w, memoryview) and hasattr(w, 'release')):
+                w.release()
+
+
+def zero(data):
+    """ Overwrite a bytearray, or SecretBuffer, with zeros """
+    if(isinstance(data, SecretBuffer)):
+        data.wipe()
+    else:
+        wipe(data)
+
+
+def secretbuffer(size):
+    """ Return a SecretBuffer for a prime of size bytes """
+    return SecretBuffer(size, lock=LOCKSECRETS)
+
+
+def parserandoms(args, needoffsets=True):
+    """ Parse cmdline random-file [offset] arguments into a list of (filename, offset) """
+    """ With needoffsets they come in pairs, otherwise an offset may follow a file and is None when left out """
+    randoms = []
+    i = 0
+    while(i < len(args)):
+        offset = None
+        if(i+1 < len(args) and (needoffsets or args[i+1].isdigit())):
+            try:
+                offset = int(args[i+1])
+            except ValueError:
+                raise ValueError("Invalid offset {}".format(args[i+1]))
+            i += 1
+        elif(needoffsets):
+            raise ValueError("Missing offset for {}".format(args[i]))
+        randoms.append((args[i-1] if offset is not None else args[i], offset))
+        i += 1
+    return randoms
+
+
+def openrandoms(randoms):
+    """ Open the pads for a list of (filename, offset), prompting for a second random on stdin when there is only one; returns a list of (pad, offset) """
+    if(len(randoms) not in (1, 2)):
+        raise ValueError("Expected one or two random files")
+    pads = []
+    try:
+        for (filename, offset) in randoms:
+            pads.append((PadSource(filename), offset))
+        if(len(pads) == 1):
+            # Read second random from stdin, its offset is 0
+            sys.stderr.write("Enter second random: ")
+            pads.append((bytearray(binascii.unhexlify(sys.stdin.readline().strip())), 0))
+        elif(pads[0][0].sameas(pads[1][0])):
+            raise ValueError("both sets of random data are the same!")
+    except:
+        closepads(pads)
+        raise
+    return pads
+
+
+def closepads(pads):
+    """ Close the PadSource pads and zero the in-memory ones """
+    for (pad, offset) in pads:
+        if(isinstance(pad, PadSource)):
+            pad.close()
+        else:
+            zero(pad)
+
+
+def keyprime(pem_bytes):
+    """ Read an unencrypted (PEM or DER) RSA private key, returning mod, exp and p1 in a SecretBuffer, to be closed by the caller """
+    pk = privkey_read.indexprivkey(pem_bytes if isinstance(pem_bytes, bytearray) else bytearray(pem_bytes))
+    mod, exp, p1 = privkey_read.keyparts(pk)
+    p1_bin = secretbuffer((p1.bit_length()+7) // 8)
+    int2bytes(p1, len(p1_bin), p1_bin.buf)
+    return (mod, exp, p1_bin)
+
+
+def primetag(mod, exp, p1_bin):
+    """ Return the integrity tag of the unmasked p1: a truncated HMAC-SHA256 keyed with the DER encoded public key """
+    key = bytes(privkey_write.writeseqtlvasn1([mod, exp]))
+    return bytearray(hmac.new(key, p1_bin, hashlib.sha256).digest()[0:TAGSIZE])
+
+
+def checktag(mod, exp, p1_bin, tag):
+    """ Check the unmasked p1 against its integrity tag, raising ValueError when it does not match """
+    if(not hmac.compare_digest(bytes(primetag(mod, exp, p1_bin)), bytes(tag))):
+        raise ValueError("Integrity tag mismatch: wrong random data or offsets for this key")
+
+
+def split_key(pem_bytes, pads):
+    """ Split an unencrypted (PEM or DER) RSA private key, returning mod, exp and the XOR-ed p1 as a bytearray """
+    (mod, exp, p1_bin) = keyprime(pem_bytes)
+    with p1_bin:
+        return (mod, exp, xorpads(p1_bin.buf, pads))
+
+
+def assemble_key(mod, exp, p1_bin, tag=None, rounds=None):
+    """ Assemble mod, exp and the unmasked p1 into a DER encoded private key as a bytearray, zeroing p1_bin """
+    """ With the integrity tag of p1 a wrong p1 is rejected before reconstructing the key """
+    """ With rounds the key is validated by checkprivkey, with that many Miller-Rabin rounds """
+    try:
+        if(tag is not None):
+            checktag(mod, exp, p1_bin, tag)
+        p1 = bytes2int(p1_bin)
+    finally:
+        zero(p1_bin)
+    pkey = privkey_write.mkprivkey(mod, exp, p1)
+    if(rounds is not None):
+        privkey_write.checkprivkey(pkey, rounds)
+    return privkey_write.writeseqtlvasn1(pkey)
+
+
+def join_key(mod, exp, xor, pads, tag=None, rounds=None):
+    """ Join mod, exp and the XOR-ed p1 with the pads, returning the DER encoded private key as a bytearray """
+    """ tag and rounds are as for assemble_key """
+    with secretbuffer(len(xor)) as p1_bin:
+        return assemble_key(mod, exp, xorpads(xor, pads, p1_bin.buf), tag, rounds)
+
+
+def formatsplit(mod, exp, xor):
+    """ Format mod, exp and XOR-ed p1 as the three line exchange format """
+    return "mod=%x\nexp=%d\nXOR=%s\n" % (mod, exp, binascii.hexlify(xor).decode('ASCII'))
+
+
+def parsesplitrecord(text):
+    """ Parse the three line exchange format, returning mod, exp, the XOR-ed p1 as a bytearray, and the pad offsets and integrity tag if recorded, otherwise None """
+    mod = exp = xor = offsets = tag = None
+    for line in text.split('\n'):
+        line = line.strip()
+        if line.startswith("mod="):
+            mod = int(line[4:], 16)
+        elif line.startswith("exp="):
+            exp = int(line[4:])
+        elif line.startswith("XOR="):
+            xor = bytearray.fromhex(line[4:])
+        elif line.startswith("offsets="):
+            offsets = [int(offset) for offset in line[8:].split()]
+        elif line.startswith("tag="):
+            tag = bytearray(binascii.unhexlify(line[4:]))
+    if(mod is None or exp is None or xor is None):
+        raise ValueError("Missing mod=, exp= or XOR= in input")
+    return (mod, exp, xor, offsets, tag)
+
+
+def parsesplit(text):
+    """ Parse the three line exchange format, returning mod, exp and the XOR-ed p1 as a bytearray """
+    return parsesplitrecord(text)[0:3]
+
+
+def packoffsets(offsets):
+    """ Pack pad offsets into the value of a frameoffsets field """
+    return struct.pack('>%dQ' % len(offsets), *offsets)
+
+
+def unpackoffsets(octets):
+    """ Unpack the value of a frameoffsets field into a list of offsets """
+    return list(struct.unpack('>%dQ' % (len(octets) // 8), bytes(bytearray(octets))))
+
+
+def packsplit(mod, exp, xor, extra=()):
+    """ Pack mod, exp and XOR-ed p1, plus extra (tag, value) fields, as a binary frame """
+    return privkey_write.packparts(mod, exp, xor, privkey_write.framemasked, extra)
+
+
+def unpacksplit(octets, offs=0):
+    """ Unpack the binary frame at offs, returning mod, exp, the XOR-ed p1 as a bytearray, all fields and the offset after the frame """
+    (mod, exp, xor, flags, fields, offs) = privkey_write.unpackparts(octets, offs)
+    if(not flags & privkey_write.framemasked):
+        raise ValueError("The prime in the frame is not masked")
+    return (mod, exp, bytearray(xor), fields, offs)
+
+
+def dumpsplit(mod, exp, xor, binary=False, label=None, offsets=None, tag=None):
+    """ Dump mod, exp and XOR-ed p1, optionally labelled and with the pad offsets and integrity tag, in the text or binary exchange format, returning a bytearray """
+    if(binary):
+        extra = []
+        if(label is not None):
+            extra.append((privkey_write.framelabel, bytearray(label, 'utf-8')))
+        if(offsets is not None):
+            extra.append((privkey_write.frameoffsets, packoffsets(offsets)))
+        if(tag is not None):
+            extra.append((privkey_write.frametag, tag))
+        return packsplit(mod, exp, xor, extra)
+    text = ""
+    if(label is not None):
+        text += "key=%s\n" % label
+    if(offsets is not None):
+        text += "offsets=%s\n" % " ".join(str(offset) for offset in offsets)
+    if(tag is not None):
+        text += "tag=%s\n" % binascii.hexlify(tag).decode('ASCII')
+    text += formatsplit(mod, exp, xor)
+    if(label is not None):
+        # Labelled records are separated by an empty line
+        text += "\n"
+    return bytearray(text, 'utf-8')
+
+
+def loadsplitrecord(octets):
+    """ Load the exchange data in either format, returning mod, exp, the XOR-ed p1 as a bytearray, and the pad offsets and integrity tag if recorded, otherwise None """
+    if(octets.startswith(privkey_write.framemagic)):
+        (mod, exp, xor, fields, offs) = unpacksplit(octets)
+        offsets = tag = None
+        if(privkey_write.frameoffsets in fields):
+            offsets = unpackoffsets(fields[privkey_write.frameoffsets])
+        if(privkey_write.frametag in fields):
+            tag = bytearray(fields[privkey_write.frametag])
+        return (mod, exp, xor, offsets, tag)
+    return parsesplitrecord(octets.decode('utf-8'))
+
+
+def loadsplit(octets):
+    """ Load the exchange data in either format, returning mod, exp and the XOR-ed p1 as a bytearray """
+    return loadsplitrecord(octets)[0:3]
+
+
+def recordedoffsets(pads, offsets):
+    """ Fill in the offsets left out (None) in pads from the leading offsets recorded with a split key """
+    if(any(offset is None for (pad, offset) in pads)):
+        if(offsets is None or len(offsets) < len(pads)):
+            raise ValueError("No offsets recorded for {} pads".format(len(pads)))
+        pads = [(pad, offset if offset is not None else recorded) for ((pad, offset), recorded) in zip(pads, offsets)]
+    return pads
+
+
+def binarystdout():
+    """ Return stdout as a binary file object """
+    return getattr(sys.stdout, 'buffer', sys.stdout)
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# (C) Nikhef 2019 Mischa Salle
+
+# Stage timing for the RCauth private key exchange (--stats). It
+# - wraps the functions of each stage (PEM decode, TLV parse, arithmetic,
+#   XOR, DER encode, PEM armour, subprocess calls, ...) with a timer,
+#   optionally also capturing their peak memory with tracemalloc,
+# - collects the statistics of batch workers into the main process,
+# - reports the number of calls, time and peak memory of each stage as
+#   JSON.
+#
+# Nothing is wrapped until enable() is called, so when disabled the stages
+# run exactly as without this module.  Wrapping replaces the functions in
+# every loaded module of the exchange, also where they were imported by
+# name.  Times are exclusive: the time of a stage called from another
+# stage (e.g. DER encode from the integrity tag) only counts for the inner
+# one.  Peak memory is that since the stage, or the last stage it called,
+# started.  Only functions of the exchange itself are wrapped, never those
+# of the standard library; coroutines, such as the openssl processes of
+# privkey_opensslpool.py, time themselves and add() their time, which sums
+# over the processes running at once.
+
+import os
+import sys
+import threading
+import time
+
+# Imported by enable(memory=True), where available (Python 3.9 or later)
+tracemalloc = None
+
+
+# The functions of each stage: (module, function, stage)
+stages = [
+    ('privkey_read', 'pemtoasn', 'pem decode'),
+    ('privkey_read', 'indexprivkey', 'tlv parse'),
+    ('privkey_read', 'parseprivkey', 'tlv parse'),
+    ('privkey_read', 'keyparts', 'tlv parse'),
+    ('privkey_write', 'mkprivkey', 'arithmetic'),
+    ('privkey_write', 'checkprivkey', 'validate'),
+    ('privkey_write', 'writeseqtlvasn1', 'der encode'),
+    ('privkey_write', 'armourprivkey', 'pem armour'),
+    ('privkey_split', 'xorpads', 'xor'),
+    ('privkey_split', 'zero', 'zero'),
+    ('privkey_split', 'primetag', 'integrity tag'),
+    ('privkey_split', 'dumpsplit', 'exchange format'),
+    ('privkey_split', 'loadsplitrecord', 'exchange format'),
+    ('privkey_shamir', 'splitsecret', 'shamir'),
+    ('privkey_shamir', 'joinsecret', 'shamir'),
+    ('privkey_openssl', 'checkoutput', 'subprocess'),
+    ('__main__', 'encryptkey', 'subprocess'),
+    ('__main__', 'inputpipe', 'subprocess'),
+    ('__main__', 'waitinput', 'subprocess'),
+]
+
+# Modules imported by enable(), so that their by-name imports get wrapped
+# too, even when the run imports them later
+modules = ['privkey_read', 'privkey_write', 'privkey_split', 'privkey_ledger',
+           'privkey_batch', 'privkey_search', 'privkey_shamir', 'privkey_archive',
+           'privkey_openssl']
+
+enabled = False
+tracing = False
+started = None
+
+# stage -> [calls, seconds, peak bytes]
+totals = {}
+
+# Per thread, the time spent in stages called from the running stages,
+# innermost last
+local = threading.local()
+
+
+def timed(f, stage):
+    """ Return f wrapped with a timer for stage """
+    def wrapper(*args, **kwargs):
+        children = getattr(local, 'children', None)
+        if(children is None):
+            children = local.children = []
+        children.append(0.0)
+        if(tracing):
+            start = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        t = time.time()
+        try:
+            return f(*args, **kwargs)
+        finally:
+            elapsed = time.time()-t
+            child = children.pop()
+            if(children):
+                children[-1] += elapsed
+            s = totals.setdefault(stage, [0, 0.0, 0])
+            s[0] += 1
+            s[1] += elapsed-child
+            if(tracing):
+                s[2] = max(s[2], tracemalloc.get_traced_memory()[1]-start)
+    wrapper.__name__ = getattr(f, '__name__', stage)
+    wrapper.__doc__ = f.__doc__
+    return wrapper
+
+
+def enable(memory=False):
+    """ Wrap the functions of all stages, with memory also capturing their peak memory """
+    global enabled, tracing, started, tracemalloc
+    if(enabled):
+        return
+    for name in modules:
+        __import__(name)
+    here = os.path.dirname(os.path.abspath(__file__))
+    ours = [m for m in list(sys.modules.values())
+            if m is not None and os.path.dirname(os.path.abspath(getattr(m, '__file__', None) or os.devnull)) == here]
+    for (modname, funcname, stage) in stages:
+        mod = sys.modules.get(modname)
+        f = getattr(mod, funcname, None)
+        if(f is None):
+            continue
+        wrapper = timed(f, stage)
+        setattr(mod, funcname, wrapper)
+        for m in ours:
+            for (attr, value) in list(vars(m).items()):
+                if(value is f):
+                    setattr(m, attr, wrapper)
+    if(memory):
+        try:
+            import tracemalloc
+        except ImportError:
+            pass
+        if(hasattr(tracemalloc, 'reset_peak')):
+            tracemalloc.start()
+            tracing = True
+    started = time.time()
+    enabled = True
+
+
+def add(stage, seconds):
+    """ Add a call of stage taking seconds, timed by the caller """
+    s = totals.setdefault(stage, [0, 0.0, 0])
+    s[0] += 1
+    s[1] += seconds
+
+
+def collect(args):
+    """ Batch worker: run worker on item, returning its result and the statistics of the run """
+    (worker, item) = args
+    totals.clear()
+    result = worker(item)
+    stats = dict(totals)
+    totals.clear()
+    return (result, stats)
+
+
+def merge(stats):
+    """ Add the statistics collected by a batch worker """
+    for (stage, (calls, seconds, peak)) in stats.items():
+        s = totals.setdefault(stage, [0, 0.0, 0])
+        s[0] += calls
+        s[1] += seconds
+        s[2] = max(s[2], peak)
+
+
+def report(f=None):
+    """ Write the statistics as JSON to f, by default stderr """
+    if(not enabled):
+        return
+    import json
+    result = {}
+    for (stage, (calls, seconds, peak)) in sorted(totals.items()):
+        result[stage] = {"calls": calls, "seconds": round(seconds, 6)}
+        if(tracing):
+            result[stage]["peak_bytes"] = peak
+    out = f or sys.stderr
+    out.write(json.dumps({"stages": result, "seconds": round(time.time()-started, 6)}, sort_keys=True)+"\n")
+    out.flush()
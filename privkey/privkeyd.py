@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# (C) Nikhef 2019 Mischa Salle
+
+# Split/join daemon for the RCauth private key exchange. It
+# - listens on a Unix domain socket, accessible by its owner only,
+# - keeps the random files given on its command line open and
+#   memory-mapped,
+# - answers split and join requests in the binary framing (see
+#   privkey_write.py), handling the connections concurrently with asyncio
+#   and the splits and joins themselves in a pool of threads.
+#
+# A request is a single frame with a frameop field:
+# - opsplit: the unencrypted private key in framekey, the names of the
+#   random files in framepads and optionally their offsets in
+#   frameoffsets.  The answer is the frame convert.py --binary prints,
+#   with the offsets and integrity tag.  With --ledger, left out offsets
+#   are allocated from the ledgers of the random files.
+# - opjoin: a frame as printed by convert.py --binary, with the names of
+#   the random files in framepads.  The answer has the unencrypted DER
+#   private key in framekey.
+# A failed request is answered with a frame holding only frameerror.  A
+# connection can carry any number of requests, each answered in turn.
+# A request with a field longer than maxfield, or that is not a frame, is
+# answered with an error frame, after which the connection is closed.
+# Random files are named as given on the command line; other files are
+# refused.  With --audit-log <file>, every split and join is appended to
+# that audit log (see privkey_audit.py) before it is answered, one at a
+# time.  splitrequest(), joinrequest() and request() build and send
+# requests for clients.
+#
+# Requires Python 3.5 or later.
+#
+# Usage: privkeyd.py [--ledger] [--audit-log <file>] <socket> <random-file> [<random-file> ...]
+
+import asyncio
+import os
+import signal
+import socket
+import stat
+import sys
+import threading
+
+import privkey_write
+from privkey_write import frameheader, framefield, packframe, unpackframe
+from privkey_split import PadSource, closepads, dumpsplit, join_key, loadsplitrecord, packoffsets, unpackoffsets, zero
+from privkey_ledger import Ledger, split_key_ledger
+from privkey_audit import AuditLog, event
+
+
+# Operations
+opsplit = 1
+opjoin = 2
+
+# Largest field accepted in a request, a 16384 bit PEM key is some 13 kB;
+# a longer field gets an error answer and the connection is closed
+maxfield = 65536
+
+
+class PadCache(object):
+    """ The random files the daemon may use, opened and memory-mapped once, and the audit log """
+
+    def __init__(self, filenames, ledger=False, ledgerdir=None, auditlog=None):
+        self.pads = {}
+        self.ledgers = {}
+        self.auditlog = AuditLog(auditlog) if auditlog is not None else None
+        # Requests are answered in several threads
+        self.auditlock = threading.Lock()
+        try:
+            for name in filenames:
+                pad = PadSource(name)
+                self.pads[name] = pad
+                self.ledgers[name] = Ledger(name, len(pad), ledgerdir) if ledger else None
+        except:
+            self.close()
+            raise
+
+    def lookup(self, names, offsets):
+        """ Return the (pad, offset) pads and their ledgers for the pad names and offsets (None if left out) """
+        pads = []
+        ledgers = []
+        for (name, offset) in zip(names, offsets):
+            if(name not in self.pads):
+                raise ValueError("Random data {} is not served".format(name))
+            if(offset is None and self.ledgers[name] is None):
+                raise ValueError("No offset for random data {}".format(name))
+            pads.append((self.pads[name], offset))
+            ledgers.append(self.ledgers[name])
+        return (pads, ledgers)
+
+    def audit(self, op, mod, exp, pads, length):
+        """ Record a split or join in the audit log, if there is one """
+        if(self.auditlog is None):
+            return
+        entry = event(op, mod, exp, pads, length)
+        with self.auditlock:
+            self.auditlog.append(entry)
+
+    def close(self):
+        closepads([(pad, 0) for pad in self.pads.values()])
+        self.pads = {}
+
+
+def padnames(fields):
+    """ Return the names of the pads of a request """
+    if(privkey_write.framepads not in fields):
+        raise ValueError("Request lacks the names of the random data")
+    return bytes(fields[privkey_write.framepads]).decode('utf-8').split('\0')
+
+
+def dosplit(cache, fields):
+    """ Split the key of a split request, returning the answer frame """
+    if(privkey_write.framekey not in fields):
+        raise ValueError("Split request lacks the key")
+    names = padnames(fields)
+    if(privkey_write.frameoffsets in fields):
+        offsets = unpackoffsets(fields[privkey_write.frameoffsets])
+        if(len(offsets) != len(names)):
+            raise ValueError("Split request has {} random files but {} offsets".format(len(names), len(offsets)))
+    else:
+        offsets = [None]*len(names)
+    (pads, ledgers) = cache.lookup(names, offsets)
+    key = bytearray(fields[privkey_write.framekey])
+    try:
+        (mod, exp, xor, offsets, tag) = split_key_ledger(key, pads, ledgers)
+    finally:
+        zero(key)
+    try:
+        cache.audit("split", mod, exp, zip([pad for (pad, o) in pads], offsets), len(xor))
+        return dumpsplit(mod, exp, xor, True, None, offsets, tag)
+    finally:
+        zero(xor)
+
+
+def dojoin(cache, octets, fields):
+    """ Join the key of a join request, returning the answer frame """
+    names = padnames(fields)
+    (mod, exp, xor, offsets, tag) = loadsplitrecord(octets)
+    try:
+        if(offsets is None or len(offsets) < len(names)):
+            raise ValueError("Join request lacks the offsets")
+        (pads, ledgers) = cache.lookup(names, offsets)
+        der = join_key(mod, exp, xor, pads, tag)
+        length = len(xor)
+    finally:
+        zero(xor)
+    try:
+        cache.audit("join", mod, exp, pads, length)
+        return packframe([(privkey_write.framekey, der)])
+    finally:
+        zero(der)
+
+
+def errorframe(e):
+    """ Return the answer frame of a failed request """
+    return packframe([(privkey_write.frameerror, str(e).encode('utf-8'))])
+
+
+def answer(cache, octets):
+    """ Answer one request frame, returning the answer frame """
+    """ Any error, also in the random files or in the key, is answered with an error frame """
+    try:
+        (flags, fields, offs) = unpackframe(octets)
+        if(privkey_write.frameop not in fields):
+            raise ValueError("Request lacks the operation")
+        op = privkey_write.getintframe(fields[privkey_write.frameop])
+        if(op == opsplit):
+            return dosplit(cache, fields)
+        if(op == opjoin):
+            return dojoin(cache, octets, fields)
+        raise ValueError("Unknown operation {}".format(op))
+    except Exception as e:
+        return errorframe(e)
+
+
+async def readframe(reader):
+    """ Read one frame from the stream, returning it as a bytearray, or None at the end of the stream """
+    try:
+        header = await reader.readexactly(frameheader.size)
+    except asyncio.IncompleteReadError as e:
+        if(e.partial):
+            raise ValueError("Truncated frame header")
+        return None
+    octets = bytearray(header)
+    (magic, version, flags, nfields) = frameheader.unpack(header)
+    if(magic != privkey_write.framemagic):
+        raise ValueError("Not a frame")
+    for i in range(nfields):
+        head = await reader.readexactly(framefield.size)
+        (tag, n) = framefield.unpack(head)
+        if(n > maxfield):
+            raise ValueError("Field of {} bytes exceeds the maximum of {}".format(n, maxfield))
+        octets += head
+        octets += await reader.readexactly(n)
+    return octets
+
+
+def handler(cache):
+    """ Return the connection handler for the server """
+    async def handle(reader, writer):
+        loop = asyncio.get_event_loop()
+        try:
+            while(True):
+                try:
+                    octets = await readframe(reader)
+                except ValueError as e:
+                    # The stream cannot be followed any further
+                    writer.write(errorframe(e))
+                    await writer.drain()
+                    break
+                if(octets is None):
+                    break
+                # The arithmetic takes up to tens of milliseconds for large
+                # keys, it runs in a thread so the loop keeps serving others
+                try:
+                    result = await loop.run_in_executor(None, answer, cache, octets)
+                finally:
+                    zero(octets)
+                writer.write(result)
+                zero(result)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            pass
+        finally:
+            writer.close()
+    return handle
+
+
+def serve(path, cache):
+    """ Serve requests on the Unix domain socket path until interrupted or terminated """
+    if(os.path.exists(path)):
+        if(not stat.S_ISSOCK(os.lstat(path).st_mode)):
+            raise ValueError("{} exists and is not a socket".format(path))
+        os.unlink(path)
+    loop = asyncio.new_event_loop()
+    umask = os.umask(0o077)
+    try:
+        server = loop.run_until_complete(asyncio.start_unix_server(handler(cache), path))
+    finally:
+        os.umask(umask)
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+    loop.add_signal_handler(signal.SIGINT, loop.stop)
+    try:
+        loop.run_forever()
+    finally:
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+        loop.close()
+        os.unlink(path)
+
+
+def splitrequest(key, names, offsets=None):
+    """ Build a split request for the unencrypted key with the named pads, offsets None to allocate them """
+    fields = [(privkey_write.frameop, opsplit),
+              (privkey_write.framekey, key),
+              (privkey_write.framepads, '\0'.join(names).encode('utf-8'))]
+    if(offsets is not None):
+        fields.append((privkey_write.frameoffsets, packoffsets(offsets)))
+    return packframe(fields)
+
+
+def joinrequest(frame, names):
+    """ Build a join request for a frame as printed by convert.py --binary with the named pads """
+    (flags, fields, offs) = unpackframe(frame)
+    fields = [(tag, value) for (tag, value) in fields.items()]
+    fields.append((privkey_write.frameop, opjoin))
+    fields.append((privkey_write.framepads, '\0'.join(names).encode('utf-8')))
+    return packframe(fields, flags)
+
+
+def request(path, frame, sock=None):
+    """ Send a request frame to the daemon at path (or over the connected sock), returning the fields of the answer """
+    """ Raises ValueError with the message of a failed request """
+    if(sock is None):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(path)
+            return request(path, frame, sock)
+    sock.sendall(frame)
+    f = sock.makefile("rb")
+    header = f.read(frameheader.size)
+    octets = bytearray(header)
+    if(len(header) < frameheader.size):
+        raise ValueError("Connection closed by privkeyd")
+    for i in range(frameheader.unpack(header)[3]):
+        head = f.read(framefield.size)
+        octets += head
+        octets += f.read(framefield.unpack(head)[1])
+    (flags, fields, offs) = unpackframe(octets)
+    if(privkey_write.frameerror in fields):
+        raise ValueError(bytes(fields[privkey_write.frameerror]).decode('utf-8'))
+    return fields
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(
+        usage="%(prog)s [--ledger] [--audit-log <file>] <socket> <random-file> [<random-file> ...]")
+    parser.add_argument("--ledger", action="store_true",
+                        help="allocate left out offsets from the ledgers of the random files")
+    parser.add_argument("--audit-log", metavar="file",
+                        help="record every split and join in the audit log file")
+    parser.add_argument("socket", help=argparse.SUPPRESS)
+    parser.add_argument("randoms", nargs="+", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    try:
+        cache = PadCache(args.randoms, args.ledger, auditlog=args.audit_log)
+    except (IOError, ValueError) as e:
+        sys.stderr.write("ERROR: %s\n" % e)
+        return 1
+    try:
+        serve(args.socket, cache)
+    except (OSError, ValueError) as e:
+        sys.stderr.write("ERROR: %s\n" % e)
+        return 1
+    finally:
+        cache.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())